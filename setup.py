@@ -15,15 +15,17 @@ setup(
     author='STEM Alliance of Fargo Moorhead',
     author_email='wfrobotics@gmail.com',
     packages=find_packages(),
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     entry_points={
         'console_scripts': [
             'track = tracker.vision:main',
             'track_local = tracker.vision:main_local',
+            'track_bench = tracker.bench:main',
             ]
     },
     install_requires=[
         'argparse',
+        'numpy',
         'opencv-python',
     ],
     extras_require={
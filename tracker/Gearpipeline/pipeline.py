@@ -2,12 +2,16 @@ import cv2
 import numpy
 import math
 from enum import Enum
+from time import perf_counter
+
+from tracker.contours import filter_contours
+from tracker.threshold import ColorThreshold
 
 
 class Pipeline:
     """OpenCV pipeline generated by GRIP"""
 
-    def __init__(self):
+    def __init__(self, threshold_mode='convert'):
         """initializes all values to presets or None if need to be set"""
 
         # self.__hsv_threshold_hue = [55.03597122302158, 103.20819112627986]
@@ -17,6 +21,7 @@ class Pipeline:
         self.__hsv_threshold_hue = [0.0, 180.0]
         self.__hsv_threshold_saturation = [0, 70.0]
         self.__hsv_threshold_value = [183.0, 255.0]
+        self.__hsv_threshold_stage = ColorThreshold(cv2.COLOR_BGR2HSV, threshold_mode)
 
         self.hsv_threshold_output = None
 
@@ -40,38 +45,48 @@ class Pipeline:
 
         self.filter_contours_output = None
 
+        self.stage_times = ()
+
     def process(self, source0):
         """
         Runs the pipeline and sets all outputs to new values.
         """
+        t_start = perf_counter()
         # Step HSV_Threshold0:
         self.__hsv_threshold_input = source0
-        (self.hsv_threshold_output) = self.__hsv_threshold(self.__hsv_threshold_input,
+        (self.hsv_threshold_output) = self.__hsv_threshold(self.__hsv_threshold_stage, self.__hsv_threshold_input,
                                                            self.__hsv_threshold_hue, self.__hsv_threshold_saturation, self.__hsv_threshold_value)
+        t_threshold = perf_counter()
 
         # Step Find_Contours0:
         self.__find_contours_input = self.hsv_threshold_output
         (self.find_contours_output) = self.__find_contours(
             self.__find_contours_input, self.__find_contours_external_only)
+        t_find = perf_counter()
 
         # Step Filter_Contours0:
         self.__filter_contours_contours = self.find_contours_output
         (self.filter_contours_output) = self.__filter_contours(self.__filter_contours_contours, self.__filter_contours_min_area, self.__filter_contours_min_perimeter, self.__filter_contours_min_width, self.__filter_contours_max_width,
                                                                self.__filter_contours_min_height, self.__filter_contours_max_height, self.__filter_contours_solidity, self.__filter_contours_max_vertices, self.__filter_contours_min_vertices, self.__filter_contours_min_ratio, self.__filter_contours_max_ratio)
+        t_filter = perf_counter()
+
+        self.stage_times = (('threshold', t_threshold - t_start),
+                            ('find_contours', t_find - t_threshold), ('filter', t_filter - t_find))
 
     @staticmethod
-    def __hsv_threshold(input, hue, sat, val):
+    def __hsv_threshold(stage, input, hue, sat, val):
         """Segment an image based on hue, saturation, and value ranges.
         Args:
+            stage: The ColorThreshold holding the reused buffers.
             input: A BGR numpy.ndarray.
             hue: A list of two numbers the are the min and max hue.
             sat: A list of two numbers the are the min and max saturation.
             lum: A list of two numbers the are the min and max value.
         Returns:
-            A black and white numpy.ndarray.
+            A black and white numpy.ndarray, overwritten by the next frame.
         """
-        out = cv2.cvtColor(input, cv2.COLOR_BGR2HSV)
-        return cv2.inRange(out, (hue[0], sat[0], val[0]),  (hue[1], sat[1], val[1]))
+        stage.set_range((hue[0], sat[0], val[0]),  (hue[1], sat[1], val[1]))
+        return stage.apply(input)
 
     @staticmethod
     def __find_contours(input, external_only):
@@ -87,8 +102,8 @@ class Pipeline:
         else:
             mode = cv2.RETR_LIST
         method = cv2.CHAIN_APPROX_SIMPLE
-        im2, contours, hierarchy = cv2.findContours(
-            input, mode=mode, method=method)
+        contours = cv2.findContours(
+            input, mode=mode, method=method)[-2]  # OpenCV 3 and 4
         return contours
 
     @staticmethod
@@ -112,27 +127,6 @@ class Pipeline:
         Returns:
             Contours as a list of numpy.ndarray.
         """
-        output = []
-        for contour in input_contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            if (w < min_width or w > max_width):
-                continue
-            if (h < min_height or h > max_height):
-                continue
-            area = cv2.contourArea(contour)
-            if (area < min_area):
-                continue
-            if (cv2.arcLength(contour, True) < min_perimeter):
-                continue
-            hull = cv2.convexHull(contour)
-            solid = 100 * area / cv2.contourArea(hull)
-            if (solid < solidity[0] or solid > solidity[1]):
-                continue
-            if (len(contour) < min_vertex_count or
-                    len(contour) > max_vertex_count):
-                continue
-            ratio = (float)(w) / h
-            if (ratio < min_ratio or ratio > max_ratio):
-                continue
-            output.append(contour)
-        return output
+        return filter_contours(input_contours, min_area, min_perimeter, min_width, max_width,
+                               min_height, max_height, solidity, max_vertex_count, min_vertex_count,
+                               min_ratio, max_ratio)
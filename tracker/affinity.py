@@ -0,0 +1,118 @@
+import logging
+import os
+import threading
+
+import cv2
+
+
+POLICIES = {getattr(os, name): name[6:] for name in ('SCHED_OTHER', 'SCHED_BATCH', 'SCHED_IDLE',
+                                                     'SCHED_FIFO', 'SCHED_RR')
+            if hasattr(os, name)}
+
+
+def pin(cpus, name):
+    """Restrict the calling thread, and threads it starts later, to cpus
+
+    A no-op for an empty list or where the OS has no affinity call. Returns True if pinned.
+    """
+    if not cpus or not hasattr(os, 'sched_setaffinity'):
+        return False
+    try:
+        os.sched_setaffinity(0, cpus)  # 0: The calling thread on Linux
+    except (OSError, ValueError) as e:
+        logging.getLogger('Affinity').warning("Can't pin {} to {}: {}".format(name, cpus, e))
+        return False
+    return True
+
+
+def lower_priority(increment, name):
+    """Make the calling thread nicer by increment, so it only gets CPU the others leave
+
+    Linux applies a thread id's priority to that thread alone. Returns True if lowered.
+    """
+    if not hasattr(os, 'setpriority'):
+        return False
+    try:
+        tid = threading.get_native_id()
+        os.setpriority(os.PRIO_PROCESS, tid, os.getpriority(os.PRIO_PROCESS, tid) + increment)
+    except OSError as e:
+        logging.getLogger('Affinity').warning("Can't lower {}'s priority: {}".format(name, e))
+        return False
+    return True
+
+
+def stage_placement(config, stage):
+    """cpus, nice and fifo priority configured for a stage: capture, worker or io
+
+    capture and worker cores default to the camera's cpus, io's to none: unpinned.
+    """
+    default_cpus = config.get('cpus') if stage in ('capture', 'worker') else None
+    return (config.get(stage + '_cpus', default_cpus), config.get(stage + '_nice', 0),
+            config.get(stage + '_fifo', 0))
+
+
+def place(config, stage, name):
+    """Pin and prioritise the calling thread as the config says for its stage, log the result
+
+    A fifo priority (1 - 99) runs the thread SCHED_FIFO, ahead of every normal thread on its
+    cores until it blocks, so only use it on cores kept for the stage. Otherwise nice is set,
+    negative needs CAP_SYS_NICE. Failures are logged and the thread carries on as it was.
+    """
+    log = logging.getLogger('Affinity')
+    log.setLevel(logging.INFO)
+    cpus, nice, fifo = stage_placement(config, stage)
+    pin(cpus, name)
+    if fifo:
+        realtime(fifo, name)
+    elif nice:
+        set_nice(nice, name)
+    log.info("{} {}".format(name, describe()))
+
+
+def realtime(priority, name):
+    """Run the calling thread SCHED_FIFO at priority. Returns True if set"""
+    if not hasattr(os, 'sched_setscheduler'):
+        return False
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))  # 0: This thread
+    except (OSError, ValueError) as e:
+        logging.getLogger('Affinity').warning("Can't make {} SCHED_FIFO {}: {}".format(
+            name, priority, e))
+        return False
+    return True
+
+
+def set_nice(nice, name):
+    """Set the calling thread's nice level. Returns True if set"""
+    if not hasattr(os, 'setpriority'):
+        return False
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+    except OSError as e:
+        logging.getLogger('Affinity').warning("Can't set {}'s nice to {}: {}".format(
+            name, nice, e))
+        return False
+    return True
+
+
+def set_cv_threads(count, name):
+    """Size OpenCV's thread pool, shared by the whole process. Negative leaves it as is"""
+    log = logging.getLogger('Affinity')
+    log.setLevel(logging.INFO)
+    if count >= 0:
+        cv2.setNumThreads(count)
+    log.info("{} OpenCV threads: {}".format(name, cv2.getNumThreads()))
+
+
+def describe():
+    """Effective placement of the calling thread, as the OS has it"""
+    tid = threading.get_native_id()
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else 'any'
+    if hasattr(os, 'sched_getscheduler'):
+        policy = os.sched_getscheduler(0)
+        priority = os.sched_getparam(0).sched_priority
+        scheduling = '{} {}'.format(POLICIES.get(policy, policy), priority)
+    else:
+        scheduling = 'default'
+    nice = os.getpriority(os.PRIO_PROCESS, tid) if hasattr(os, 'getpriority') else 0
+    return "thread {}: cpus {}, policy {}, nice {}".format(tid, cpus, scheduling, nice)
@@ -0,0 +1,162 @@
+"""Offline pipeline benchmark: per stage latency, throughput and allocations as JSON
+
+    track_bench [--frames DIR_VIDEO_OR_RAW] [--output results.json]
+
+Replays recorded frames through the generated GRIP pipelines and the .grip files. Without a
+corpus, synthetic frames with moving PowerCube and Gear like targets are generated, so it runs
+on any Linux box.
+"""
+import argparse
+import json
+import os
+import platform
+import tracemalloc
+
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from tracker.Gearpipeline.pipeline import Pipeline as GearPipeline
+from tracker.grip import load_pipeline
+from tracker.pipeline import Pipeline as PowerCubePipeline
+from tracker.recording import read_recording
+
+
+PIPELINES = {
+    'powercube': PowerCubePipeline,
+    'gear': GearPipeline,
+    'powercube_grip': lambda: load_pipeline('PowerCube.grip'),
+    'gear_grip': lambda: load_pipeline('Gearpipeline/Gear.grip'),
+}
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+
+def load_frames(path, count, width, height):
+    """Frames from a directory of images, a video file or a recording, synthetic if path is None"""
+    if path is None:
+        return synthetic_frames(count, width, height)
+    if path.endswith('.raw'):
+        frames = [frame for _, frame in read_recording(path)[:count]]
+    elif os.path.isdir(path):
+        names = sorted(n for n in os.listdir(path) if n.lower().endswith(IMAGE_EXTENSIONS))
+        frames = [cv2.imread(os.path.join(path, n)) for n in names[:count]]
+    else:
+        stream = cv2.VideoCapture(path)
+        frames = []
+        while len(frames) < count:
+            retval, frame = stream.read()
+            if not retval:
+                break
+            frames.append(frame)
+        stream.release()
+    if not frames:
+        raise SystemExit("No frames in {}".format(path))
+    return frames
+
+
+def synthetic_frames(count, width, height, seed=4818):
+    """Noisy field with a yellow cube and white tape drifting across it"""
+    rng = np.random.default_rng(seed)
+    background = rng.integers(0, 90, (height, width, 3), dtype=np.uint8)
+    frames = []
+    for i in range(count):
+        frame = background.copy()
+        phase = 2 * np.pi * i / count
+        x = int(width * (.4 + .25 * np.sin(phase)))
+        y = int(height * (.5 + .2 * np.cos(phase)))
+        cv2.rectangle(frame, (x - 60, y - 50), (x + 60, y + 50), (0, 220, 240), -1)
+        cv2.rectangle(frame, (x + 120, y - 80), (x + 150, y + 80), (250, 250, 250), -1)
+        speckle = rng.integers(0, 4, (height, width), dtype=np.uint8) == 0
+        frame[speckle] //= 2
+        frames.append(frame)
+    return frames
+
+
+def percentiles(samples):
+    """p50/p95/p99 in milliseconds"""
+    ms = np.asarray(samples) * 1000.0
+    p50, p95, p99 = np.percentile(ms, (50, 95, 99))
+    return {'p50_ms': round(p50, 3), 'p95_ms': round(p95, 3), 'p99_ms': round(p99, 3)}
+
+
+def host():
+    """What a benchmark ran on, for its report"""
+    return {
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'cpus': os.cpu_count(),
+    }
+
+
+def write_report(results, path=None):
+    """Results as JSON, to stdout when there is no path"""
+    report = json.dumps(results, indent=4)
+    if path is None:
+        print(report)
+    else:
+        with open(path, 'w') as f:
+            f.write(report)
+
+
+def bench_pipeline(make_pipeline, frames, warmup):
+    """Time every stage of every frame, then measure allocations in a second pass"""
+    pipeline = make_pipeline()
+    for frame in frames[:warmup]:
+        pipeline.process(frame)
+
+    stages = {}
+    totals = []
+    targets = 0
+    for frame in frames:
+        t_start = perf_counter()
+        pipeline.process(frame)
+        totals.append(perf_counter() - t_start)
+        for name, seconds in pipeline.stage_times:
+            stages.setdefault(name, []).append(seconds)
+        targets += len(pipeline.filter_contours_output)
+
+    peaks = []
+    for frame in frames:
+        tracemalloc.start()  # Restarted per frame, reset_peak() needs Python 3.9
+        pipeline.process(frame)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {
+        'frames': len(frames),
+        'targets_per_frame': round(targets / len(frames), 3),
+        'throughput_fps': round(len(frames) / sum(totals), 1),
+        'total': percentiles(totals),
+        'stages': {name: percentiles(samples) for name, samples in stages.items()},
+        'alloc_peak_bytes_per_frame': int(np.mean(peaks)),
+    }
+
+
+def main():
+    arg_parse = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parse.add_argument('--frames', help='Directory of images, a video file or a .raw recording')
+    arg_parse.add_argument('--count', type=int, default=300, help='Max frames to replay')
+    arg_parse.add_argument('--width', type=int, default=640, help='Synthetic frame width')
+    arg_parse.add_argument('--height', type=int, default=480, help='Synthetic frame height')
+    arg_parse.add_argument('--warmup', type=int, default=10)
+    arg_parse.add_argument('--pipeline', choices=sorted(PIPELINES), action='append',
+                           help='Pipeline(s) to run, default all')
+    arg_parse.add_argument('--output', help='Write JSON here instead of stdout')
+    args = arg_parse.parse_args()
+
+    frames = load_frames(args.frames, args.count, args.width, args.height)
+    results = {
+        'host': host(),
+        'corpus': args.frames or 'synthetic',
+        'resolution': list(frames[0].shape[1::-1]),
+        'pipelines': {},
+    }
+    for name in args.pipeline or sorted(PIPELINES):
+        results['pipelines'][name] = bench_pipeline(PIPELINES[name], frames, args.warmup)
+    write_report(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
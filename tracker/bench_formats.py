@@ -0,0 +1,130 @@
+"""Pick the capture format: cost of getting each one from the driver to a target mask
+
+    python -m tracker.bench_formats [--src 0] [--output formats.json]
+
+For MJPG, BGR and raw YUYV frames, times the decode or conversion the driver would do plus
+the builtin pipeline with each threshold mode, on synthetic frames encoded every way. With
+--src the camera is also opened in each format and its frame rate and grab time measured.
+"""
+import argparse
+import json
+import os
+
+from functools import partial
+from time import perf_counter
+
+import cv2
+
+from tracker.bench import host, percentiles, synthetic_frames, write_report
+from tracker.camera import fourcc, frame_shape, make_camera
+from tracker.pipeline import Pipeline
+
+
+# Name, fourcc, convert_rgb: the formats a USB camera commonly offers
+FORMATS = (
+    ('mjpg', 'MJPG', 1),
+    ('yuyv_bgr', 'YUYV', 1),
+    ('yuyv_raw', 'YUYV', 0),
+)
+
+
+def encoded(frames, name):
+    """frames as the driver hands them to the decode step of that format"""
+    if name == 'mjpg':
+        return [cv2.imencode('.jpg', frame)[1] for frame in frames]
+    return [cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_YUYV) for frame in frames]
+
+
+def decoder(name):
+    """What OpenCV does to a frame of that format before read() returns it"""
+    if name == 'mjpg':
+        return partial(cv2.imdecode, flags=cv2.IMREAD_COLOR)
+    if name == 'yuyv_bgr':
+        return partial(cv2.cvtColor, code=cv2.COLOR_YUV2BGR_YUYV)
+    return lambda frame: frame
+
+
+def bench_format(name, frames, threshold_mode, warmup):
+    """Decode then process every frame, p50/p95/p99 of each and the total"""
+    decode = decoder(name)
+    pipeline = Pipeline(threshold_mode=threshold_mode)
+    for frame in frames[:warmup]:
+        pipeline.process(decode(frame))
+    decodes, totals = [], []
+    for frame in frames:
+        t_start = perf_counter()
+        image = decode(frame)
+        t_decoded = perf_counter()
+        pipeline.process(image)
+        decodes.append(t_decoded - t_start)
+        totals.append(perf_counter() - t_start)
+    return {
+        'throughput_fps': round(len(frames) / sum(totals), 1),
+        'decode': percentiles(decodes),
+        'total': percentiles(totals),
+    }
+
+
+def bench_camera(src, name, code, convert_rgb, width, height, count):
+    """Frame rate and grab + retrieve time of a camera opened in the format"""
+    with open(os.path.join(os.path.dirname(__file__), 'config', 'robot.json'), 'r') as f:
+        config = json.load(f)  # Camera settings as on the robot
+    config.update({'src': src, 'width': width, 'height': height, 'rotate': 0, 'fourcc': code,
+                   'convert_rgb': convert_rgb})
+    stream, _, raw = make_camera(config)
+    if not stream.isOpened():
+        return {'error': 'camera did not open'}
+    result = {'negotiated': fourcc(stream), 'raw': raw,
+              'resolution': list(frame_shape(stream, raw)[1::-1])}
+    if name == 'yuyv_raw' and not raw:
+        stream.release()
+        result['error'] = 'driver will not give raw YUYV'
+        return result
+    reads, t_reads = [], []
+    for _ in range(count):
+        t_start = perf_counter()
+        if not stream.grab() or not stream.retrieve()[0]:
+            break
+        t_reads.append(perf_counter())
+        reads.append(t_reads[-1] - t_start)
+    stream.release()
+    if len(reads) < 2:
+        result['error'] = 'no frames'
+        return result
+    result['fps'] = round((len(reads) - 1) / (t_reads[-1] - t_reads[0]), 1)
+    result['read'] = percentiles(reads)
+    return result
+
+
+def main():
+    arg_parse = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parse.add_argument('--src', type=int, help='Camera to also measure capture from')
+    arg_parse.add_argument('--count', type=int, default=120)
+    arg_parse.add_argument('--warmup', type=int, default=10)
+    arg_parse.add_argument('--width', type=int, default=640)
+    arg_parse.add_argument('--height', type=int, default=480)
+    arg_parse.add_argument('--output', help='Write JSON here instead of stdout')
+    args = arg_parse.parse_args()
+
+    frames = synthetic_frames(args.count, args.width, args.height)
+    results = {
+        'host': host(),
+        'resolution': [args.width, args.height],
+        'processing': {},
+    }
+    for name, _, _ in FORMATS:
+        source = encoded(frames, name)
+        for threshold_mode in ('convert', 'lut'):
+            results['processing']['{}_{}'.format(name, threshold_mode)] = bench_format(
+                name, source, threshold_mode, args.warmup)
+    fastest = max(results['processing'].items(), key=lambda item: item[1]['throughput_fps'])
+    results['fastest_processing'] = fastest[0]
+    if args.src is not None:
+        results['capture'] = {name: bench_camera(args.src, name, code, convert_rgb, args.width,
+                                                 args.height, args.count)
+                              for name, code, convert_rgb in FORMATS}
+    write_report(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
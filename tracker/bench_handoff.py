@@ -0,0 +1,135 @@
+"""Measure the camera to processor hand-off: consumer CPU use, wake-up and end to end latency
+
+    python -m tracker.bench_handoff
+
+Compares the old busy-wait polling (empty() + sleep(0)) with a blocking get. Then, with a
+processor slower than the camera, times each frame from its capture to when it is done for
+the old full() check before reading, a ring the camera can grab into while the queue is full,
+and the ring sized so it can't.
+"""
+import argparse
+import json
+
+from multiprocessing import Process, Queue
+from queue import Empty
+from time import perf_counter, process_time, sleep, time
+
+from tracker.frame_ring import FrameRing
+from tracker.vision import make_ring
+
+
+def producer(queue, frames, fps):
+    """Stand-in camera, publishes a timestamp at the camera frame rate"""
+    for _ in range(frames):
+        sleep(1.0 / fps)
+        queue.put(time())
+    queue.put(None)
+
+
+def consume_polling(queue):
+    """Baseline - spin on empty()"""
+    while True:
+        if queue.empty():
+            sleep(0)
+            continue
+        yield queue.get()
+
+
+def consume_blocking(queue):
+    """Block in get(), wake when the producer publishes"""
+    while True:
+        try:
+            yield queue.get(True, timeout=.1)
+        except Empty:
+            continue
+
+
+def measure(consumer, frames, fps):
+    queue = Queue(1)
+    camera = Process(target=producer, args=(queue, frames, fps), daemon=True)
+    camera.start()
+    latencies = []
+    wall_start = perf_counter()
+    cpu_start = process_time()
+    for t_sent in consumer(queue):
+        if t_sent is None:
+            break
+        latencies.append((time() - t_sent) * 1000.0)
+    cpu = process_time() - cpu_start
+    wall = perf_counter() - wall_start
+    camera.join()
+    latencies.sort()
+    return {
+        'cpu_percent': round(100.0 * cpu / wall, 1),
+        'latency_ms_p50': round(latencies[len(latencies) // 2], 3),
+        'latency_ms_p99': round(latencies[int(len(latencies) * .99)], 3),
+    }
+
+
+def camera(ring, queue, frames, fps, poll_full):
+    """Stand-in camera, grabs wait for the next frame the sensor delivers"""
+    t_start = time()
+    for frame_id in range(1, frames + 1):
+        if poll_full:
+            while queue.full():  # Baseline - poll until the processor takes the last frame
+                sleep(.01)
+        slot = ring.acquire()  # Block: Until the processor frees a slot
+        elapsed = time() - t_start
+        t_taken = t_start + (int(elapsed * fps) + 1) / fps
+        sleep(t_taken - time())  # Block: Exposure
+        ring.publish(slot, frame_id, t_taken)
+        queue.put(slot)  # Block: Until the queue has room
+    queue.put(None)
+
+
+def measure_capture(ring, poll_full, frames, fps, process_ms):
+    """Capture to processed latency of one worker taking process_ms a frame"""
+    queue = Queue(1)
+    producer = Process(target=camera, args=(ring, queue, frames, fps, poll_full), daemon=True)
+    producer.start()
+    latencies = []
+    while True:
+        slot = queue.get()
+        if slot is None:
+            break
+        ring.take(slot)
+        t_taken = ring.stamps(slot)[1]
+        sleep(process_ms / 1000.0)  # Processing
+        latencies.append((time() - t_taken) * 1000.0)
+        ring.release(slot)
+    producer.join()
+    ring.close()
+    latencies.sort()
+    return {
+        'slots': ring.slots,
+        'latency_ms_p50': round(latencies[len(latencies) // 2], 1),
+        'latency_ms_p99': round(latencies[int(len(latencies) * .99)], 1),
+    }
+
+
+def main():
+    arg_parse = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parse.add_argument('--frames', type=int, default=300)
+    arg_parse.add_argument('--fps', type=float, default=30.0)
+    arg_parse.add_argument('--process_ms', type=float, default=50.0,
+                           help='Processing time per frame for the capture to processed runs')
+    args = arg_parse.parse_args()
+
+    config = {'height': 8, 'width': 8, 'workers': 1, 'capture': 'queue'}
+    results = {
+        'polling': measure(consume_polling, args.frames, args.fps),
+        'blocking': measure(consume_blocking, args.frames, args.fps),
+        'capture_to_processed': {
+            'poll_full': measure_capture(make_ring(config, 1), True, args.frames, args.fps,
+                                         args.process_ms),
+            'grab_then_wait': measure_capture(FrameRing.create(3, 8, 8), False, args.frames,
+                                              args.fps, args.process_ms),
+            'sized_ring': measure_capture(make_ring(config, 1), False, args.frames, args.fps,
+                                          args.process_ms),
+        },
+    }
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
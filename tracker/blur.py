@@ -0,0 +1,16 @@
+import cv2
+
+
+def binary_median(src, ksize):
+    """Median filter for a 0/255 mask via an integral box sum and a majority vote
+
+    The median of a window of 0s and 255s is 255 exactly when more than half the window is
+    255, so counting with a box sum gives the same answer as cv2.medianBlur. Borders are
+    replicated like medianBlur does. Equivalence tolerance: 0 differing pixels for any
+    0/255 input and odd ksize. Inputs with other values are not medians, use medianBlur.
+
+    Cost does not grow with ksize, vs the per-pixel histogram medianBlur keeps.
+    """
+    sums = cv2.boxFilter(src, cv2.CV_32S, (ksize, ksize), normalize=False,
+                         borderType=cv2.BORDER_REPLICATE)
+    return cv2.compare(sums, 255 * (ksize * ksize // 2), cv2.CMP_GT)
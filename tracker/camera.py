@@ -1,60 +1,322 @@
 import logging
 import multiprocessing
+import os
 
-from queue import Full
+from queue import Empty, Full
 from time import sleep, time
 
 import cv2
+import numpy as np
 
+from tracker.affinity import place, set_cv_threads
+from tracker.recording import read_recording, Recorder, ReplaySource
 
-def camera_process(config, queue):
-    """Process main - Camera"""
+
+# MessageConfig field to camera property, applied live
+LIVE_SETTINGS = (
+    ('Exposure', 'exposure', cv2.CAP_PROP_EXPOSURE),
+    ('Brightness', 'brightness', cv2.CAP_PROP_BRIGHTNESS),
+    ('Saturation', 'saturation', cv2.CAP_PROP_SATURATION),
+)
+# MessageConfig field to config key, the camera is reopened to change them
+REOPEN_SETTINGS = (
+    ('Source', 'src'),
+    ('Width', 'width'),
+    ('Height', 'height'),
+)
+RECONNECT_MIN = 0.05  # Seconds, first retry after a failed open, doubling to reconnect_max
+
+
+def camera_configs(config):
+    """One config per camera: the top level keys overridden by each "cameras" entry
+
+    Without "cameras" the top level config is the only camera, id 0. With several, each is
+    labelled cam<id> to tell their metrics and video streams apart.
+    """
+    entries = config.get('cameras') or [{}]
+    configs = []
+    for index, entry in enumerate(entries):
+        camera = {key: value for key, value in config.items() if key != 'cameras'}
+        camera.update(entry)
+        camera.setdefault('id', index)
+        camera['label'] = 'cam{}'.format(camera['id']) if len(entries) > 1 else ''
+        configs.append(camera)
+    return configs
+
+
+def camera_process(config, ring, queue, control=None):
+    """Process main - Camera
+
+    control carries MessageConfig from the RIO. Frames larger than the ring was sized for are
+    scaled down to fit.
+    """
     log = multiprocessing.log_to_stderr()
     log.setLevel(logging.INFO)
+    set_cv_threads(config.get('cv_threads', -1), 'Camera{}'.format(config.get('id', 0)))
 
-    log.info("Starting")
-    disconnected = True
+    latest = config.get('capture', 'queue') == 'latest'
+    log.info("Starting camera {}, capture mode: {}".format(config.get('id', 0),
+                                                           'latest' if latest else 'queue'))
+    recorder = start_recorder(config, ring)
+    place(config, 'capture', 'Camera{}'.format(config.get('id', 0)))  # After the recorder starts
+    connection = Connection(config, log)
+    frame_id = 0
     try:
         while True:
-            if disconnected:
-                disconnected, stream, rotate = connect(config)
-                if not disconnected:
-                    log.info("Connected")
+            message = latest_message(control)
+            if message is not None and apply_settings(connection.stream, config, message, log):
+                connection.lose('reopen')
+            if connection.stream is None and not connection.open(ring):
                 continue
-            if queue.full():
+            slot = ring.acquire(timeout=.1)  # Block: Ahead of processor until it frees a slot
+            if slot is None:
                 log.debug("Full")
-                sleep(.01) # Ahead of processor
                 continue
 
-            retval, frame = stream.read()
-            if not retval:
-                disconnected = True
-                log.warning("Disconnected")
+            t_taken = connection.capture(ring, slot)
+            if t_taken is None:
+                ring.release(slot)
+                connection.lose('disconnect')
+                log.warning("Disconnected, {} frames dropped".format(ring.dropped))
                 continue
-
-            if rotate is None:
-                queue.put((frame, time()))
-            else:
-                queue.put((cv2.rotate(frame, rotate), time()))
+            frame_id += 1
+            hand_off(ring, queue, slot, frame_id, t_taken, recorder, latest)
     except KeyboardInterrupt:
         log.info("Stopping")
     finally:
         queue.close()
         queue.join_thread()
-        if stream.isOpened():
-            stream.release()
+        connection.close()
+        if recorder is not None:
+            recorder.shutdown()
+            recorder.join()
     log.info("Exiting")
 
 
+class Connection(object):
+    """The camera's stream, reopened when lost
+
+    A missing camera is retried with exponential backoff, only opened once its device is
+    there again. The time from losing frames to the next one is logged.
+    """
+    def __init__(self, config, log):
+        self.config = config
+        self.log = log
+        self.stream = None
+        self.rotate = None
+        self.raw = False
+        self.shape = None
+        self.in_place = False
+        self.backoff = 0.0
+        self.t_lost, self.lost = time(), 'start'  # Blind since, measured to the next frame
+
+    def open(self, ring):
+        """Back off, then try once to open the stream. Returns True if connected"""
+        if self.backoff:
+            sleep(self.backoff)  # Block: Camera missing, back off
+        if device_present(self.config['src']):
+            disconnected, stream, self.rotate, self.raw = connect(self.config)
+            if not disconnected:
+                self.stream = stream
+                self.backoff = 0.0
+                self.shape = frame_shape(stream, self.raw)
+                self.in_place = (self.rotate is None and self.shape[0] > 0 and
+                                 ring.fits(self.shape))
+                self.log.info("Connected, {} frames".format(
+                    'raw YUYV' if self.raw else fourcc(stream) or 'BGR'))
+                return True
+            stream.release()
+        self.backoff = min(max(2 * self.backoff, RECONNECT_MIN),
+                           self.config.get('reconnect_max', 2.0))
+        return False
+
+    def capture(self, ring, slot):
+        """Frame into the slot, returns the time it was taken or None if disconnected"""
+        t_taken = capture(self.stream, ring, slot, self.shape if self.in_place else None,
+                          self.rotate, self.shape if self.raw else None)
+        if t_taken is not None and self.t_lost is not None:
+            self.log.info("First frame {:.2f}s after {}".format(t_taken - self.t_lost, self.lost))
+            self.t_lost = None
+        return t_taken
+
+    def lose(self, reason):
+        """Close the stream, it is reopened on the next open()"""
+        self.close()
+        self.t_lost, self.lost = time(), reason
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.release()
+            self.stream = None
+
+
+def start_recorder(config, ring):
+    """Started Recorder of every frame when the config asks for one, else None"""
+    if not config.get('record'):
+        return None
+    recorder = Recorder(config['record'], config.get('label') or 'cam{}'.format(
+        config.get('id', 0)), ring.slot_bytes)
+    recorder.start()
+    return recorder
+
+
+def hand_off(ring, queue, slot, frame_id, t_taken, recorder, latest):
+    """Record the captured slot, stamp it and pass it to the processor"""
+    if recorder is not None:
+        recorder.record(ring.frame(slot), frame_id, t_taken)
+    ring.publish(slot, frame_id, t_taken)
+    if latest:
+        ring.count_dropped(publish_latest(ring, queue, slot))
+    else:
+        queue.put(slot)  # The ring has no slot for the camera while the queue is full
+
+
+def latest_message(control):
+    """Newest MessageConfig waiting, or None"""
+    message = None
+    while control is not None:
+        try:
+            message = control.get_nowait()
+        except Empty:
+            break
+    return message
+
+
+def apply_settings(stream, config, message, log):
+    """Update config from message, set what can be live. Returns True if stream must reopen"""
+    for field, key, prop in LIVE_SETTINGS:
+        value = getattr(message, field)
+        if value != config[key]:
+            config[key] = value
+            if stream is not None and stream.isOpened():
+                stream.set(prop, value)
+                log.info("Set {} to {}".format(key, value))
+    reopen = False
+    for field, key in REOPEN_SETTINGS:
+        value = getattr(message, field)
+        if value != config[key]:
+            config[key] = value
+            reopen = True
+    if reopen:
+        log.info("Reopening source {} at {}x{}".format(config['src'], config['width'],
+                                                       config['height']))
+    return reopen and stream is not None
+
+
+def capture(stream, ring, slot, shape, rotate, raw_shape=None):
+    """Grab then decode into the slot, returns the time of the grab or None if disconnected
+
+    raw_shape is the YUYV frame shape when the driver hands frames over unconverted.
+    """
+    if not stream.grab():
+        return None
+    t_taken = time()  # As close to exposure as the driver lets us get
+    if shape is not None:  # Driver decodes straight into shared memory
+        retval, frame = stream.retrieve(ring.writable(slot, shape))
+    else:
+        retval, frame = stream.retrieve()
+    if not retval:
+        return None
+    if raw_shape is not None and frame.shape != raw_shape:
+        frame = frame.reshape(raw_shape)  # Some drivers give one row of bytes
+    store(ring, slot, frame, rotate)
+    return t_taken
+
+
+def publish_latest(ring, queue, slot):
+    """Hand off slot, replacing any frame not yet taken. Returns the number of frames dropped"""
+    dropped = 0
+    while True:
+        try:
+            queue.put_nowait(slot)
+            return dropped
+        except Full:
+            try:
+                ring.release(queue.get(True, timeout=.01))  # Stale, the processor never saw it
+                dropped += 1
+            except Empty:
+                pass  # Processor took it meanwhile
+
+
+def frame_shape(stream, raw=False):
+    """Shape of the frames the driver is delivering, 2 bytes a pixel when raw YUYV"""
+    return (int(stream.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            int(stream.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            2 if raw else 3)
+
+
+def fourcc(stream):
+    """Pixel format the driver negotiated, e.g. 'YUYV' or 'MJPG', '' if it won't say"""
+    code = int(stream.get(cv2.CAP_PROP_FOURCC))
+    return ''.join(chr((code >> shift) & 0xFF) for shift in (0, 8, 16, 24)).strip('\0')
+
+
+def store(ring, slot, frame, rotate):
+    """Place frame into its ring slot, a no-op when read() already wrote it in place"""
+    if rotate is not None:
+        shape = (frame.shape[1], frame.shape[0], frame.shape[2])
+        if ring.fits(shape):
+            cv2.rotate(frame, rotate, dst=ring.writable(slot, shape))
+            return
+        frame = cv2.rotate(frame, rotate)
+    elif ring.holds(slot, frame):
+        return
+    if not ring.fits(frame.shape):  # Driver ignored the requested resolution
+        scale = (ring.slot_bytes / frame.nbytes) ** 0.5
+        frame = cv2.resize(frame, (int(frame.shape[1] * scale), int(frame.shape[0] * scale)))
+    np.copyto(ring.writable(slot, frame.shape), frame)
+
+
+def device_present(src):
+    """Cheap check that a camera could open, before paying for a VideoCapture"""
+    if isinstance(src, int):
+        return not os.path.isdir('/dev') or os.path.exists('/dev/video{}'.format(src))
+    if src.startswith('/dev/') or src.endswith('.raw'):
+        return os.path.exists(src)
+    return True  # A URL or pipeline, only opening it tells
+
+
 def connect(config):
     """Try to connect to hardware"""
-    stream, rotate = make_camera(config)
+    stream, rotate, raw = make_camera(config)
     disconnected = not stream.isOpened()
-    return disconnected, stream, rotate
+    return disconnected, stream, rotate, raw
+
+
+def expected_shape(config):
+    """Shape frames will have once the camera connects, to warm up pipelines before it does
+
+    2 channels for raw YUYV when the config asks for it, as make_camera() decides, with
+    fourcc unset assumed to be a USB camera's usual YUYV. A recording's is its own.
+    """
+    src = config['src']
+    if isinstance(src, str) and src.endswith('.raw'):
+        try:
+            frames = read_recording(src)
+            if len(frames):
+                return frames[0][1].shape
+        except (OSError, ValueError):
+            pass  # Camera reports it when it can't open
+    height, width = config['height'], config['width']
+    rotate = config.get('rotate', 0)
+    if rotate in (90, -90):
+        height, width = width, height
+    raw = (config.get('convert_rgb', 1) == 0 and rotate == 0 and
+           config.get('fourcc', '') in ('', 'YUYV'))
+    return height, width, 2 if raw else 3
 
 
 def make_camera(config):
-    """Returns configured camera stream"""
+    """Returns configured camera stream, a recording when src is a .raw file
+
+    "fourcc" picks the pixel format, e.g. MJPG or YUYV. With "convert_rgb" 0 a YUYV camera's
+    frames are used as they come, the thresholds work on them without converting to BGR.
+    They can't be rotated, so rotated cameras still convert.
+    """
+    if isinstance(config['src'], str) and config['src'].endswith('.raw'):
+        # Recorded after rotation, settings can't change it
+        return ReplaySource(config['src'], config.get('replay_pace', 'realtime')), None, False
+
     rotate_options = {
         0 : None,
         90 : cv2.ROTATE_90_CLOCKWISE,
@@ -63,11 +325,15 @@ def make_camera(config):
     }
 
     stream = cv2.VideoCapture(config['src'])
+    if config.get('fourcc'):
+        stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*config['fourcc']))
     stream.set(cv2.CAP_PROP_FRAME_WIDTH, config['width'])
     stream.set(cv2.CAP_PROP_FRAME_HEIGHT, config['height'])
     stream.set(cv2.CAP_PROP_EXPOSURE, config['exposure'])
     stream.set(cv2.CAP_PROP_BRIGHTNESS, config['brightness'])
     stream.set(cv2.CAP_PROP_SATURATION, config['saturation'])
     rotate = rotate_options[config['rotate']]
+    raw = (config.get('convert_rgb', 1) == 0 and rotate is None and fourcc(stream) == 'YUYV' and
+           stream.set(cv2.CAP_PROP_CONVERT_RGB, 0))
 
-    return stream, rotate 
+    return stream, rotate, raw
@@ -0,0 +1,105 @@
+"""Check the array contour filter keeps exactly the contours the GRIP per contour loop does
+
+    python -m tracker.check_contours [--frames DIR_VIDEO_OR_RAW] [--count 10]
+
+Contours are found in every frame at several thresholds, then filtered by both with the
+pipeline's limits and with random ones. Exits non zero on the first frame where they differ.
+"""
+import argparse
+import sys
+
+import cv2
+import numpy as np
+
+from tracker.bench import load_frames
+from tracker.contours import filter_contours
+from tracker.yuyv import is_yuyv
+
+
+DEFAULT_LIMITS = (0.0, 50.0, 50.0, 1000, 50.0, 1000, [0, 100], 1000000, 0, 0, 1000)
+
+
+def grip_filter_contours(input_contours, min_area, min_perimeter, min_width, max_width,
+                         min_height, max_height, solidity, max_vertex_count, min_vertex_count,
+                         min_ratio, max_ratio):
+    """The generated GRIP loop, unchanged but for skipping solidity when the hull has no area
+
+    The original divides by zero there, filter_contours keeps the contour.
+    """
+    output = []
+    for contour in input_contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if (w < min_width or w > max_width):
+            continue
+        if (h < min_height or h > max_height):
+            continue
+        area = cv2.contourArea(contour)
+        if (area < min_area):
+            continue
+        if (cv2.arcLength(contour, True) < min_perimeter):
+            continue
+        hull_area = cv2.contourArea(cv2.convexHull(contour))
+        if hull_area > 0:
+            solid = 100 * area / hull_area
+            if (solid < solidity[0] or solid > solidity[1]):
+                continue
+        if (len(contour) < min_vertex_count or len(contour) > max_vertex_count):
+            continue
+        ratio = (float)(w) / h
+        if (ratio < min_ratio or ratio > max_ratio):
+            continue
+        output.append(contour)
+    return output
+
+
+def random_limits(rng):
+    """Limits that each keep some of the contours and drop others"""
+    low_solidity = rng.uniform(0, 90)
+    return (rng.uniform(0, 200), rng.uniform(0, 100), rng.uniform(0, 30), rng.uniform(30, 700),
+            rng.uniform(0, 30), rng.uniform(30, 500),
+            [low_solidity, rng.uniform(low_solidity, 100)],
+            int(rng.integers(10, 500)), int(rng.integers(0, 10)), rng.uniform(0, 1),
+            rng.uniform(1, 10))
+
+
+def contour_sets(frame):
+    """Contours of the frame at a few thresholds, with two chain approximations"""
+    if is_yuyv(frame):
+        gray = frame[:, :, 0]
+    else:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    for level in (40, 100, 200):
+        mask = cv2.threshold(gray, level, 255, cv2.THRESH_BINARY)[1]
+        for method in (cv2.CHAIN_APPROX_SIMPLE, cv2.CHAIN_APPROX_TC89_KCOS):
+            yield cv2.findContours(mask, mode=cv2.RETR_LIST, method=method)[-2]
+
+
+def main():
+    arg_parse = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parse.add_argument('--frames', help='Directory of images, video or .raw recording')
+    arg_parse.add_argument('--count', type=int, default=10)
+    arg_parse.add_argument('--limits', type=int, default=10, help='Random limit sets per frame')
+    arg_parse.add_argument('--width', type=int, default=640)
+    arg_parse.add_argument('--height', type=int, default=480)
+    args = arg_parse.parse_args()
+
+    rng = np.random.default_rng(4818)
+    frames = load_frames(args.frames, args.count, args.width, args.height)
+    contours = kept = 0
+    for index, frame in enumerate(frames):
+        for found in contour_sets(frame):
+            contours += len(found)
+            for limits in [DEFAULT_LIMITS] + [random_limits(rng) for _ in range(args.limits)]:
+                expected = grip_filter_contours(found, *limits)
+                actual = filter_contours(found, *limits)
+                if len(actual) != len(expected) or any(
+                        a is not e for a, e in zip(actual, expected)):
+                    sys.exit("Frame {} differs with limits {}: GRIP kept {}, filter_contours {}"
+                             .format(index, limits, len(expected), len(actual)))
+                kept += len(actual)
+    print("{} frames, {} contours, {} kept over all limits: identical".format(
+        len(frames), contours, kept))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,59 +1,158 @@
+import asyncio
 import logging
-import multiprocessing
 import socket
 
-from threading import Lock, Thread
-from time import sleep, time
+from threading import Lock
 
+from tracker.message_config import MessageParser
 
-class NetworkClient(Thread):
-    """Communicates with RoboRIO server socket"""
+
+class NetworkClient(object):
+    """Communicates with RoboRIO server socket, from the IO loop
+
+    transmit() never blocks the vision thread: it swaps the message into its camera's one deep
+    slot and wakes the loop. A message still waiting when the same camera's next arrives is
+    coalesced (replaced), so a busy camera never pushes out another's. While disconnected
+    messages are dropped. Reconnects back off from 0.1s to 2s.
+    'tcp' sends with Nagle off so each message leaves at once. 'udp' sends each message as
+    one datagram, nothing is retransmitted so a lost message is replaced by the next one.
+    MessageConfig lines sent back by the RIO are passed to on_config, on the IO loop.
+    """
     def __init__(self, config):
-        super(NetworkClient, self).__init__(name='COM')
-        self.log = logging.getLogger('COM') 
+        self.log = logging.getLogger('COM')
         self.log.setLevel(logging.INFO)
         self.address = (config['host'], config['port'])
-        self.lock = Lock() # Reduce latency by locking vs enqueuing
+        self.transport = config.get('transport', 'tcp')
+        if self.transport not in ('tcp', 'udp'):
+            raise ValueError("Unknown transport '{}'".format(self.transport))
+        self.backoff = (0.1, 2.0)
+        self.timeout = 1.0  # Connect
+        self.lock = Lock()  # Held only to swap the pending messages
+        self.pending = {}  # Camera id to its newest message not yet sent
         self.connected = False
-        self.running = True
-        self.connect()
-        self.log.info("Timeout for COM operations: {}s".format(self.sock.gettimeout()))
+        self.loop = None
+        self.wake = None
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.parser = None
+        self.on_config = None
 
-    def shutdown(self):
-        """Stop thread - Allow RIO socket to disconnect gracefully"""
-        self.running = False
+    def transmit(self, coprocessor_data, camera=0):
+        """Queue message bytes for the RIO, returns at once"""
+        data = bytes(coprocessor_data)  # Encoders reuse their buffer
+        with self.lock:
+            if not self.connected:
+                self.dropped += 1
+                return
+            waiting = bool(self.pending)
+            if camera in self.pending:
+                self.coalesced += 1
+            self.pending[camera] = data
+            if waiting:
+                return  # Loop already woken
+        self.loop.call_soon_threadsafe(self.wake.set)
 
-    def run(self):
-        """Thread main - Service Connecting, transmit is done from calling thread"""
+    async def run(self):
+        """Service main - Connect, send, reconnect with backoff"""
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        delay = self.backoff[0]
         self.log.info("Starting")
-        while self.running:
-            if not self.connected:
-                self.connect()
-            sleep(0.1) # Yield: Between servicing connection
-        self.log.info("Stopping")
-        self.sock.close()
-
-    def transmit(self, coprocessor_data):
-        """Send message over the socket to RIO"""
-        self.lock.acquire()
-        if self.connected:
+        while True:
             try:
-                self.sock.sendall(coprocessor_data.encode())
-            except (ConnectionResetError, socket.error) as e:
-                self.log.error(e)
-                self.connected = False
-        self.lock.release()
-
-    def connect(self):
-        """Init socket"""
-        self.lock.acquire()
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(.25)  # So socket connect() fails fast
-        try:
-            self.sock.connect(self.address)
+                if self.transport == 'udp':
+                    send, closed, close = await self.open_udp()
+                else:
+                    send, closed, close = await self.open_tcp()
+            except (OSError, asyncio.TimeoutError):
+                await asyncio.sleep(delay)  # Yield: RIO not up yet
+                delay = min(delay * 2, self.backoff[1])
+                continue
+            delay = self.backoff[0]
+            self.parser = MessageParser()  # A partial line does not survive reconnecting
             self.connected = True
             self.log.info('Connected to {}'.format(self.address))
-        except socket.error as e:
-            self.sock.close()
-            self.connected = False
-        self.lock.release()
+            try:
+                await self.send_until(send, closed)
+            except (ConnectionError, OSError) as e:
+                self.log.error(e)
+            finally:
+                with self.lock:
+                    self.connected = False
+                    self.pending = {}
+                close()
+            self.log.warning("Disconnected, {} messages dropped, {} coalesced".format(
+                self.dropped, self.coalesced))
+
+    def receive(self, data):
+        """Bytes from the RIO, forward any complete MessageConfig"""
+        for message in self.parser.feed(data):
+            self.log.info("Config from RIO: source {}, {}x{}, exposure {}, brightness {}, "
+                          "saturation {}".format(message.Source, message.Width, message.Height,
+                                                 message.Exposure, message.Brightness,
+                                                 message.Saturation))
+            if self.on_config is not None:
+                self.on_config(message)
+
+    async def send_until(self, send, closed):
+        """Send the pending messages each time transmit() wakes the loop, until closed"""
+        watch = asyncio.ensure_future(closed)
+        try:
+            while not watch.done():
+                wake = asyncio.ensure_future(self.wake.wait())
+                await asyncio.wait((wake, watch), return_when=asyncio.FIRST_COMPLETED)
+                wake.cancel()
+                self.wake.clear()
+                with self.lock:
+                    batch, self.pending = self.pending, {}
+                for data in batch.values():  # Every camera's newest, in arrival order
+                    await send(data)  # Congested: newer messages coalesce meanwhile
+                    self.sent += 1
+            watch.result()  # Raises why the connection closed
+        finally:
+            watch.cancel()
+
+    async def open_tcp(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.address),
+                                                self.timeout)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        async def send(data):
+            writer.write(data)
+            await writer.drain()
+
+        async def closed():
+            data = await reader.read(1024)
+            while data:
+                self.receive(data)
+                data = await reader.read(1024)
+            raise ConnectionResetError("Connection closed by RIO")
+
+        return send, closed(), writer.close
+
+    async def open_udp(self):
+        errors = asyncio.Queue()
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: Datagrams(self.receive, errors), remote_addr=self.address)
+
+        async def send(data):
+            transport.sendto(data)
+
+        async def closed():
+            raise await errors.get()
+
+        return send, closed(), transport.close
+
+
+class Datagrams(asyncio.DatagramProtocol):
+    """Passes datagrams from the RIO on, and send errors, e.g. its port being closed"""
+    def __init__(self, receive, errors):
+        self.receive = receive
+        self.errors = errors
+
+    def datagram_received(self, data, addr):
+        self.receive(data if data.endswith(b'\n') else data + b'\n')  # One message each
+
+    def error_received(self, exc):
+        self.errors.put_nowait(exc)
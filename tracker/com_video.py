@@ -1,45 +1,217 @@
+import asyncio
 import cv2
+import json
+import re
 
-from queue import Empty, Queue
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
 
-from http.server import BaseHTTPRequestHandler,HTTPServer
-from socketserver import ThreadingMixIn
+from tracker import yuyv
+from tracker.affinity import lower_priority
 
-stream_queue = Queue(1)
 
+class SnapshotStream(object):
+    """Latest processed frame, JPEG encoded once and sent to every viewer
 
-class CamHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path.endswith('.mjpg'):
-            self.send_response(200)
-            self.send_header('Content-type','multipart/x-mixed-replace; boundary=--jpgboundary')
-            self.end_headers()
+    The processor checks full() before copying a frame: it is while nobody is watching, the
+    previous frame is still being encoded or the stream's frame rate would be exceeded, so
+    viewers never slow the vision threads. The copy is shrunk to the stream's width, and
+    encoding runs on the video server's one low priority encoder thread.
+    """
+    def __init__(self, metrics, config):
+        self.metrics = metrics
+        self.period = 1.0 / config.get('stream_fps', 15)
+        self.width = config.get('stream_width', 320)
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, config.get('stream_quality', 60)]
+        self.overlay = config.get('stream_overlay', 0) == 1
+        self.viewers = 0
+        self.busy = False
+        self.t_last = 0.0
+        self.loop = None
+        self.executor = None
+        self.updated = None
+        self.jpg = None
+        self.version = 0
+
+    def full(self):
+        return (self.loop is None or self.viewers == 0 or self.busy or
+                time() - self.t_last < self.period)
+
+    def shrink(self, frame):
+        """Copy of frame at the stream's width, from a slot about to be reused"""
+        frame_h, frame_w = frame.shape[:2]
+        if yuyv.is_yuyv(frame):  # Shrunk before converting, so only the small copy is
+            if 0 < self.width < frame_w:
+                frame = yuyv.resize(frame, (self.width, max(frame_h * self.width // frame_w, 1)),
+                                    interpolation=cv2.INTER_NEAREST)
+            return yuyv.to_bgr(frame)
+        if not 0 < self.width < frame_w:
+            return frame.copy()
+        size = (self.width, max(frame_h * self.width // frame_w, 1))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_NEAREST)  # Cheapest for workers
+
+    def put(self, snapshot, rects, frame_w):
+        """Called from the processor with a shrink() copy and its targets in frame pixels"""
+        self.busy = True
+        self.t_last = time()
+        asyncio.run_coroutine_threadsafe(self.encode(snapshot, rects, frame_w), self.loop)
+
+    async def attach(self, executor):
+        """Bind to the IO loop, encode on executor"""
+        self.updated = asyncio.Condition()
+        self.executor = executor
+        self.loop = asyncio.get_running_loop()
+
+    async def encode(self, snapshot, rects, frame_w):
+        try:
+            jpg = await self.loop.run_in_executor(self.executor, self.jpeg, snapshot, rects,
+                                                  frame_w)
+            async with self.updated:
+                self.jpg = jpg
+                self.version += 1
+                self.updated.notify_all()
+        finally:
+            self.busy = False
+
+    def jpeg(self, snapshot, rects, frame_w):
+        t_start = perf_counter()
+        if self.overlay:
+            scale = snapshot.shape[1] / frame_w
+            for x, y, w, h in rects:
+                cv2.rectangle(snapshot, (int(x * scale), int(y * scale)),
+                              (int((x + w) * scale), int((y + h) * scale)), (0, 0, 255), 2)
+        retval, jpg = cv2.imencode('.jpg', snapshot, self.params)
+        self.metrics.observe('encode', perf_counter() - t_start)
+        return jpg.tobytes()
+
+    async def next(self, version):
+        """JPEG newer than version and its version, skips any a slow viewer missed"""
+        async with self.updated:
+            await self.updated.wait_for(lambda: self.version > version)
+            return self.version, self.jpg
+
+
+class VideoServer(object):
+    """MJPEG streams, metrics and parameter tuning over HTTP, served on the IO loop
+
+    Stream and parameters are per camera, /cam<id>.mjpg and /cam<id>/params. Without an id,
+    /cam.mjpg and /params, they are the first camera's.
+    """
+    def __init__(self, address, metrics, cameras):
+        self.address = address
+        self.metrics = metrics
+        self.cameras = cameras  # Camera id to (SnapshotStream, ParameterStore)
+        self.routes = {  # Method and path after any /cam<id> to its handler
+            ('GET', '.mjpg'): self.get_mjpeg,
+            ('GET', '/metrics'): self.get_metrics,
+            ('GET', '/metrics.json'): self.get_metrics_json,
+            ('GET', '/params'): self.get_params,
+            ('POST', '/params'): self.post_params,
+            ('GET', '.html'): self.get_page,
+        }
+
+    async def run(self):
+        """Service main - Accept viewers"""
+        executor = ThreadPoolExecutor(1, 'Encoder', initializer=lower_priority,
+                                      initargs=(10, 'Encoder'))
+        for stream, _ in self.cameras.values():
+            await stream.attach(executor)
+        try:
+            server = await asyncio.start_server(self.handle, *self.address)
+            async with server:
+                await server.serve_forever()
+        finally:
+            executor.shutdown(wait=False)
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = {}
+            line = await reader.readline()
+            while line.strip():
+                name, _, value = line.decode().partition(':')
+                headers[name.strip().lower()] = value.strip()
+                line = await reader.readline()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            camera, route = self.route(path)
+            handler = self.routes.get((method, route))
+            if camera is None:
+                self.send_text(writer, 'No such camera', 'text/plain', 404)
+            elif handler is not None:
+                await handler(writer, camera, body)
+            elif any(known == route for _, known in self.routes):
+                self.send_text(writer, 'Unsupported method', 'text/plain', 405)
+            else:
+                self.send_text(writer, 'Not found', 'text/plain', 404)
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass  # Viewer went away or sent nonsense
+        except asyncio.CancelledError:
+            pass  # Shutting down, end the connection quietly
+        finally:
+            writer.close()
+
+    def route(self, path):
+        """(stream, params) of the camera a path is for or None, and the path after /cam<id>"""
+        match = re.match(r'/cam(\d*)(.*)', path)
+        if match is None or not match.group(1):
+            camera = next(iter(self.cameras.values()))
+            route = path if match is None else match.group(2)
+        else:
+            camera = self.cameras.get(int(match.group(1)))
+            route = match.group(2)
+        return camera, '.html' if route.endswith('.html') else route
+
+    async def get_mjpeg(self, writer, camera, body):
+        await self.send_mjpeg(writer, camera[0])
+
+    async def get_metrics(self, writer, camera, body):
+        self.send_text(writer, self.metrics.to_prometheus(), 'text/plain; version=0.0.4')
+
+    async def get_metrics_json(self, writer, camera, body):
+        self.send_text(writer, self.metrics.to_json(), 'application/json')
+
+    async def get_params(self, writer, camera, body):
+        self.send_params(writer, camera[1])
+
+    async def get_page(self, writer, camera, body):
+        self.send_text(writer, '<html><head></head><body>{}</body></html>'.format(''.join(
+            '<img src="/cam{}.mjpg"/>'.format(i) for i in self.cameras)), 'text/html')
+
+    async def send_mjpeg(self, writer, stream):
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-type: multipart/x-mixed-replace; boundary=--jpgboundary\r\n\r\n')
+        stream.viewers += 1
+        try:
+            version = 0
             while True:
-                try:
-                    if stream_queue.empty():
-                        sleep(0)
-                        continue
-                    img = stream_queue.get()
-                    retval, jpg = cv2.imencode('.jpg', img)
-                    jpg_bytes = jpg.tobytes()
-                    self.wfile.write(b"\r\n--jpgboundary\r\n")
-                    self.send_header('Content-type','image/jpeg')
-                    self.send_header('Content-length', len(jpg_bytes))
-                    self.end_headers()
-                    self.wfile.write(jpg_bytes)
-                except KeyboardInterrupt:
-                    break
-            return
-        if self.path.endswith('.html'):
-            self.send_response(200)
-            self.send_header('Content-type','text/html')
-            self.end_headers()
-            self.wfile.write(b'<html><head></head><body>')
-            self.wfile.write(b'<img src="http://127.0.0.1:8080/cam.mjpg"/>')
-            self.wfile.write(b'</body></html>')
+                version, jpg = await stream.next(version)
+                writer.write(b'\r\n--jpgboundary\r\nContent-type: image/jpeg\r\n'
+                             b'Content-length: %d\r\n\r\n' % len(jpg))
+                writer.write(jpg)
+                await writer.drain()  # Block: Only this viewer waits on its network
+        finally:
+            stream.viewers -= 1
+
+    async def post_params(self, writer, camera, body):
+        """Tune the pipeline: JSON object of parameter names to values, applied next frame"""
+        try:
+            camera[1].update(json.loads(body.decode()))
+        except ValueError as e:
+            self.send_text(writer, str(e), 'text/plain', 400)
             return
+        self.send_params(writer, camera[1])
+
+    def send_params(self, writer, params):
+        params = params.effective()
+        self.send_text(writer, json.dumps(params, indent=4, sort_keys=True), 'application/json')
+
+    def send_text(self, writer, text, content_type, status=200):
+        body = text.encode()
+        writer.write('HTTP/1.0 {} {}\r\nContent-type: {}\r\nContent-length: {}\r\n\r\n'.format(
+            status, STATUS[status], content_type, len(body)).encode())
+        writer.write(body)
 
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
@@ -0,0 +1,63 @@
+import cv2
+import numpy as np
+
+
+def contour_stats(contours):
+    """Bounding box size, area, perimeter and vertex count of every contour in one pass
+
+    All points are stacked into one array and reduced per contour, so the Python cost is
+    per call rather than per contour. Matches cv2.boundingRect, cv2.contourArea and
+    cv2.arcLength(closed=True), including arcLength's float32 segment lengths.
+    """
+    counts = np.fromiter((len(contour) for contour in contours), dtype=np.intp,
+                         count=len(contours))
+    starts = np.zeros_like(counts)
+    np.cumsum(counts[:-1], out=starts[1:])
+    points = np.concatenate(contours).reshape(-1, 2)
+    x = points[:, 0]
+    y = points[:, 1]
+
+    width = np.maximum.reduceat(x, starts) - np.minimum.reduceat(x, starts) + 1
+    height = np.maximum.reduceat(y, starts) - np.minimum.reduceat(y, starts) + 1
+
+    following = np.arange(1, len(points) + 1)
+    following[starts + counts - 1] = starts  # Closed: last point joins the first
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    x_next = x[following]
+    y_next = y[following]
+    area = np.abs(np.add.reduceat(x * y_next - x_next * y, starts)) / 2.0
+    dx = x_next - x
+    dy = y_next - y
+    segments = np.sqrt((dx * dx + dy * dy).astype(np.float32))
+    perimeter = np.add.reduceat(segments.astype(np.float64), starts)
+    return width, height, area, perimeter, counts
+
+
+def filter_contours(input_contours, min_area, min_perimeter, min_width, max_width,
+                    min_height, max_height, solidity, max_vertex_count, min_vertex_count,
+                    min_ratio, max_ratio):
+    """Same result as the GRIP per contour loop, size limits applied as array masks
+
+    Only contours passing every cheap test have their convex hull computed for solidity.
+    """
+    if len(input_contours) == 0:
+        return []
+    width, height, area, perimeter, counts = contour_stats(input_contours)
+    ratio = width / height
+    keep = ((width >= min_width) & (width <= max_width) &
+            (height >= min_height) & (height <= max_height) &
+            (area >= min_area) & (perimeter >= min_perimeter) &
+            (counts >= min_vertex_count) & (counts <= max_vertex_count) &
+            (ratio >= min_ratio) & (ratio <= max_ratio))
+
+    output = []
+    for index in np.flatnonzero(keep):
+        contour = input_contours[index]
+        hull_area = cv2.contourArea(cv2.convexHull(contour))
+        if hull_area > 0:  # A line has no solidity, GRIP keeps it
+            solid = 100 * area[index] / hull_area
+            if (solid < solidity[0] or solid > solidity[1]):
+                continue
+        output.append(contour)
+    return output
@@ -0,0 +1,175 @@
+from multiprocessing import Lock, Semaphore, shared_memory
+from queue import Empty
+from time import time
+
+import numpy as np
+
+
+# Slot ownership - whoever holds a slot index owns the slot
+FREE = 0  # Camera may claim it
+WRITING = 1  # Camera is filling it
+PUBLISHED = 2  # Index is in flight to the processor
+CONSUMING = 3  # Processor is reading it
+
+HEADER = np.dtype([
+    ('state', np.uint32),
+    ('height', np.uint32),
+    ('width', np.uint32),
+    ('channels', np.uint32),
+    ('frame_id', np.uint64),
+    ('t_taken', np.float64),
+    ('t_published', np.float64),
+])
+
+COUNTERS = np.dtype([
+    ('dropped', np.uint64),  # Captured frames overwritten before the processor took them
+])
+
+
+class FrameRing(object):
+    """Fixed pool of preallocated frame slots in shared memory
+
+    Only slot indices cross the process boundary. Each slot is owned by whoever holds its
+    index, so every header field has exactly one writer at a time and no lock is needed.
+    A semaphore counts free slots so the camera sleeps until the processor releases one.
+    The lock only orders freeing slots against reclaim() after a camera process dies.
+    """
+    def __init__(self, slots, slot_bytes, name=None, free=None, lock=None):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.header_bytes = HEADER.itemsize * slots + COUNTERS.itemsize
+        size = self.header_bytes + slots * slot_bytes
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = name is None
+        self.free = Semaphore(slots) if free is None else free
+        self.lock = Lock() if lock is None else lock
+        self.header = np.ndarray((slots,), dtype=HEADER, buffer=self.shm.buf)
+        self.counters = np.ndarray((1,), dtype=COUNTERS, buffer=self.shm.buf,
+                                   offset=HEADER.itemsize * slots)
+        self._slots = [np.ndarray((slot_bytes,), dtype=np.uint8, buffer=self.shm.buf,
+                                  offset=self.header_bytes + i * slot_bytes)
+                       for i in range(slots)]
+        self._next = 0
+        if self.owner:
+            self.header.fill(0)
+            self.counters.fill(0)
+
+    @classmethod
+    def create(cls, slots, height, width, channels=3):
+        """New ring sized for the largest frame it must hold"""
+        return cls(slots, height * width * channels)
+
+    def __reduce__(self):
+        """Pickle by name so a child process attaches to the same memory"""
+        return (self.__class__, (self.slots, self.slot_bytes, self.shm.name, self.free,
+                                 self.lock))
+
+    def fits(self, shape):
+        """True if a frame of this shape fits in a slot"""
+        return int(np.prod(shape)) <= self.slot_bytes
+
+    def holds(self, slot, frame):
+        """True if frame is already stored in the slot's memory"""
+        return np.may_share_memory(frame, self._slots[slot])
+
+    def acquire(self, timeout=None):
+        """Camera side - block until a slot is free and claim it, None on timeout"""
+        if not self.free.acquire(timeout=timeout):
+            return None
+        for _ in range(self.slots):
+            slot = self._next
+            self._next = (self._next + 1) % self.slots
+            if self.header['state'][slot] == FREE:
+                self.header['state'][slot] = WRITING
+                return slot
+        return None
+
+    def writable(self, slot, shape):
+        """Camera side - view of the slot to write a frame of this shape into"""
+        height, width, channels = shape
+        entry = self.header[slot]
+        entry['height'] = height
+        entry['width'] = width
+        entry['channels'] = channels
+        return self._slots[slot][:height * width * channels].reshape(shape)
+
+    def publish(self, slot, frame_id, t_taken):
+        """Camera side - stamp the slot, its index may now be handed off"""
+        entry = self.header[slot]
+        entry['frame_id'] = frame_id
+        entry['t_taken'] = t_taken
+        entry['t_published'] = time()
+        entry['state'] = PUBLISHED
+        return slot
+
+    def take(self, slot):
+        """Processor side - claim a slot just received, False if reclaim() freed it meanwhile"""
+        with self.lock:
+            if self.header['state'][slot] != PUBLISHED:
+                return False
+            self.header['state'][slot] = CONSUMING
+            return True
+
+    def frame(self, slot):
+        """View of the frame currently stored in the slot"""
+        entry = self.header[slot]
+        shape = (int(entry['height']), int(entry['width']), int(entry['channels']))
+        return self._slots[slot][:shape[0] * shape[1] * shape[2]].reshape(shape)
+
+    def stamps(self, slot):
+        """Frame id, capture and hand-off times of the frame in the slot"""
+        entry = self.header[slot]
+        return int(entry['frame_id']), float(entry['t_taken']), float(entry['t_published'])
+
+    def count_dropped(self, count):
+        """Camera side - only the camera writes the counters"""
+        self.counters['dropped'][0] += count
+
+    @property
+    def dropped(self):
+        return int(self.counters['dropped'][0])
+
+    def release(self, slot):
+        """Give the slot back to the camera"""
+        with self.lock:
+            self.header['state'][slot] = FREE
+            self.free.release()
+
+    def reclaim(self, queue):
+        """Free every slot a dead camera process still held, returns how many
+
+        With the camera gone, a slot not free and not taken by the processor was being
+        written, is waiting in the queue or was lost on the way to it, so the queue is emptied
+        and all of them freed. The free count is rebuilt, the camera may have died between
+        counting a slot down and claiming it. Only call it while the camera is not running.
+        """
+        with self.lock:
+            while True:
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    break
+                self.counters['dropped'][0] += 1  # The processor never saw it
+            states = self.header['state']
+            lost = [slot for slot in range(self.slots) if states[slot] not in (FREE, CONSUMING)]
+            states[lost] = FREE
+            while self.free.acquire(False):
+                pass
+            for _ in range(int(np.count_nonzero(states == FREE))):
+                self.free.release()
+        return len(lost)
+
+    def close(self):
+        """Detach, the creating process also frees the memory"""
+        self.header = None
+        self.counters = None
+        self._slots = []
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # A frame view is still alive, the mapping goes away with the process
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,63 @@
+import logging
+
+
+# Cheapest losses first. Factors of the configured stream rate, blur radius, ROI padding
+# and pyramid scale; skip drops every skip'th frame
+LADDER = (
+    {},
+    {'stream_rate': .5},
+    {'stream_rate': .25, 'blur': .5},
+    {'stream_rate': .25, 'blur': .5, 'roi_pad': .5},
+    {'stream_rate': .25, 'blur': .5, 'roi_pad': .5, 'downscale': 2},
+    {'stream_rate': .25, 'blur': .5, 'roi_pad': .5, 'downscale': 2, 'skip': 3},
+    {'stream_rate': .25, 'blur': .5, 'roi_pad': .5, 'downscale': 2, 'skip': 2},
+)
+
+
+class PerformanceGovernor(object):
+    """Trades quality for frame time to keep frames inside a deadline
+
+    Each window of frames, steps down the ladder if the p95 frame time missed the deadline,
+    or back up after recover windows in a row with p95 under headroom of it. The p95 is
+    exact, from the window's own frame times: a histogram's bucket would let one slow frame
+    decide. Windows don't overlap, so every decision after a step sees only frames made at
+    the new level.
+    """
+    def __init__(self, deadline, ladder=LADDER, window=30, headroom=.6, recover=3, name=''):
+        self.log = logging.getLogger('Governor' + name)
+        self.log.setLevel(logging.INFO)
+        self.deadline = deadline
+        self.ladder = ladder
+        self.window = window
+        self.headroom = headroom
+        self.recover = recover
+        self.level = 0
+        self.good = 0
+        self.samples = []
+
+    def observe(self, seconds):
+        """One frame's time, returns the new level's settings when it changes, else None"""
+        self.samples.append(seconds)
+        if len(self.samples) < self.window:
+            return None
+        p95 = sorted(self.samples)[int(.95 * (self.window - 1))]
+        self.samples = []
+        if p95 > self.deadline and self.level < len(self.ladder) - 1:
+            self.good = 0
+            return self.step(1, "frame time p95 {:.1f}ms over the {:.1f}ms deadline".format(
+                1000.0 * p95, 1000.0 * self.deadline))
+        if p95 < self.headroom * self.deadline and self.level > 0:
+            self.good += 1
+            if self.good >= self.recover:
+                self.good = 0
+                return self.step(-1, "frame time p95 {:.1f}ms, {} windows under {:.1f}ms".format(
+                    1000.0 * p95, self.recover, 1000.0 * self.headroom * self.deadline))
+        else:
+            self.good = 0
+        return None
+
+    def step(self, direction, reason):
+        self.level += direction
+        self.log.info("Quality {} to level {} {}: {}".format(
+            'down' if direction > 0 else 'up', self.level, self.ladder[self.level], reason))
+        return self.ladder[self.level]
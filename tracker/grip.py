@@ -0,0 +1,337 @@
+"""Run GRIP .grip files directly instead of hand maintained generated code
+
+load_pipeline() parses the GRIP XML into a plan: an ordered list of step specs with their
+parameters, where a threshold step followed by a median blur becomes the exact binary
+median. Plans are cached on disk as JSON keyed by the file's hash. Executing a plan reuses
+its buffers between frames, and pipelines run together on a frame share colour conversions.
+Step values are tunable at run time, named like the generated code's attributes, e.g.
+hsv_threshold_hue or filter_contours_min_width.
+"""
+import hashlib
+import json
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+
+from time import perf_counter
+
+import cv2
+
+from tracker.blur import binary_median
+from tracker.contours import filter_contours
+from tracker.params import downscaled
+from tracker import yuyv
+from tracker.threshold import ColorThreshold
+
+
+PLAN_VERSION = 2
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tracker')
+CONVERSIONS = {
+    'HSV': cv2.COLOR_BGR2HSV,
+    'HLS': cv2.COLOR_BGR2HLS,
+    'BGR': None,
+}
+SKIPPED_STEPS = ('Publish Video', 'NTPublish ContoursReport', 'Publish ContoursReport')
+FILTER_PARAMS = ('min_area', 'min_perimeter', 'min_width', 'max_width', 'min_height',
+                 'max_height', 'solidity', 'max_vertices', 'min_vertices', 'min_ratio',
+                 'max_ratio')
+_plans = {}
+
+
+def load_pipeline(paths, threshold_mode='convert'):
+    """GripPipeline for a .grip path, MultiPipeline for a list of them
+
+    Relative paths are from the tracker package directory.
+    """
+    if isinstance(paths, str):
+        return GripPipeline(load_plan(paths), threshold_mode)
+    names = [os.path.splitext(os.path.basename(p))[0].lower() for p in paths]
+    return MultiPipeline([GripPipeline(load_plan(p), threshold_mode) for p in paths], names)
+
+
+def load_plan(path, cache_dir=CACHE_DIR):
+    """Compiled plan of a .grip file, from memory or the disk cache when the file is unchanged"""
+    path = os.path.join(os.path.dirname(__file__), path)
+    with open(path, 'rb') as f:
+        xml = f.read()
+    key = '{}-{}'.format(hashlib.sha1(xml).hexdigest(), PLAN_VERSION)
+    if key in _plans:
+        return _plans[key]
+    cached = os.path.join(cache_dir, key + '.json')
+    try:
+        with open(cached, 'r') as f:
+            plan = json.load(f)
+    except (OSError, ValueError):
+        plan = compile_plan(xml)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cached, 'w') as f:
+                json.dump(plan, f)
+        except OSError:
+            pass  # Read only home, compile again next start
+    _plans[key] = plan
+    return plan
+
+
+def compile_plan(xml):
+    """Parse GRIP XML into {'steps': [spec, ...], 'output': index}
+
+    A spec's input is -1 for the camera or the index of an earlier spec.
+    """
+    root = ElementTree.fromstring(re.sub(rb'<(/?)\w+:', rb'<\1', xml))  # Undeclared grip: prefix
+    steps = [element for element in root.iter() if _tag(element) == 'Step']
+    sources = {}  # (step, socket) to (source, step) it is connected to
+    for connection in (e for e in root.iter() if _tag(e) == 'Connection'):
+        output = next(e for e in connection if _tag(e) in ('Output', 'OutputSocketImpl'))
+        target = next(e for e in connection if _tag(e) in ('Input', 'InputSocketImpl'))
+        origin = ('source', 0) if 'source' in output.attrib else ('step', int(output.get('step')))
+        sources[(int(target.get('step')), int(target.get('socket')))] = origin
+
+    specs = []
+    compiled = {}  # GRIP step number to spec index
+    named = {}  # Step name to times seen, later ones numbered
+    for number, step in enumerate(steps):
+        name = step.get('name')
+        if name in SKIPPED_STEPS:
+            continue
+        values = {}
+        for socket in (e for e in step if _tag(e) in ('Input', 'InputSocketImpl')):
+            values[int(socket.get('socket'))] = _value(socket.find('value'))
+        origin = sources.get((number, 0), ('source', 0))
+        input_index = -1 if origin[0] == 'source' else compiled[origin[1]]
+        spec = _spec(name, values, input_index, specs)
+        slug = name.lower().replace(' ', '_')
+        spec['name'] = slug + (str(named[slug]) if slug in named else '')
+        named[slug] = named.get(slug, 0) + 1
+        specs.append(spec)
+        compiled[number] = len(specs) - 1
+    return {'steps': specs, 'output': len(specs) - 1}
+
+
+def _spec(name, values, input_index, specs):
+    if name in ('HSV Threshold', 'HSL Threshold', 'RGB Threshold'):
+        if name == 'HSV Threshold':  # Channels H, S, V
+            conversion, sockets, order = 'HSV', ('hue', 'saturation', 'value'), (0, 1, 2)
+        elif name == 'HSL Threshold':  # GRIP orders hue, sat, lum, OpenCV's HLS is H, L, S
+            conversion, sockets, order = 'HLS', ('hue', 'saturation', 'luminance'), (0, 2, 1)
+        else:  # Red, green, blue thresholds on a BGR frame
+            conversion, sockets, order = 'BGR', ('red', 'green', 'blue'), (2, 1, 0)
+        spec = {'op': 'threshold', 'input': input_index, 'conversion': conversion,
+                'channels': [sockets[i] for i in order]}
+        spec.update((socket, values[i + 1]) for i, socket in enumerate(sockets))
+        return spec
+    if name == 'Blur':
+        blur_type = values[1]
+        if blur_type == 'MEDIAN' and input_index >= 0 and specs[input_index]['op'] == 'threshold':
+            blur_type = 'BINARY_MEDIAN'  # Fused: median of a 0/255 mask is a majority vote
+        return {'op': 'blur', 'input': input_index, 'type': blur_type, 'radius': values[2]}
+    if name == 'Find Contours':
+        return {'op': 'find_contours', 'input': input_index, 'external_only': values[1]}
+    if name == 'Filter Contours':
+        spec = {'op': 'filter_contours', 'input': input_index}
+        spec.update((param, values[i + 1]) for i, param in enumerate(FILTER_PARAMS))
+        return spec
+    raise ValueError("Unsupported GRIP step '{}'".format(name))
+
+
+def _tag(element):
+    """Tag without the edu.wpi.grip.core... package"""
+    return element.tag.rsplit('.', 1)[-1]
+
+
+def _value(element):
+    if element is None:
+        return None
+    if len(element):
+        return [float(child.text) for child in element]
+    text = element.text.strip()
+    if text in ('true', 'false'):
+        return text == 'true'
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+class Step(object):
+    """One plan step, its tunable values are named <step name>_<value>"""
+    def __init__(self, spec, stage, tunable):
+        self.name = stage
+        self.prefix = spec['name']
+        self.values = {key: spec[key] for key in tunable}
+        self.scale = 1
+
+    def params(self):
+        return {'{}_{}'.format(self.prefix, key): value for key, value in self.values.items()}
+
+    def set_params(self, params):
+        for key in self.values:
+            value = params.get('{}_{}'.format(self.prefix, key))
+            if value is not None:
+                self.values[key] = downscaled(key, value, self.scale)
+
+    def downscale(self, factor):
+        """Same rescaling as Pipeline.downscale"""
+        self.scale *= factor
+        for key, value in self.values.items():
+            self.values[key] = downscaled(key, value, factor)
+
+
+class ThresholdStep(Step):
+    def __init__(self, spec, threshold_mode):
+        Step.__init__(self, spec, 'threshold', spec['channels'])
+        self.conversion = spec['conversion']
+        self.channels = spec['channels']
+        self.stage = ColorThreshold(CONVERSIONS[self.conversion], threshold_mode)
+        self.set_params({})
+
+    def set_params(self, params):
+        Step.set_params(self, params)
+        self.stage.set_range([self.values[c][0] for c in self.channels],
+                             [self.values[c][1] for c in self.channels])
+
+    def run(self, src, shared):
+        if self.stage.mode == 'lut' or shared is None:
+            return self.stage.apply(src)
+        key = (id(src), self.conversion)  # Another pipeline may have converted this frame
+        converted = shared.get(key)
+        if converted is None:
+            converted = shared[key] = self.stage.convert(src)
+        return self.stage.in_range(converted)
+
+
+class BlurStep(Step):
+    def __init__(self, spec, threshold_mode):
+        Step.__init__(self, spec, 'blur', ('radius',))
+        self.type = spec['type']
+
+    def run(self, src, shared):
+        radius = round(self.values['radius'])
+        if self.type == 'BINARY_MEDIAN':
+            return binary_median(src, int(2 * radius + 1))
+        if self.type == 'MEDIAN':
+            return cv2.medianBlur(src, int(2 * radius + 1))
+        if self.type == 'BOX':
+            return cv2.blur(src, (int(2 * radius + 1),) * 2)
+        if self.type == 'GAUSSIAN':
+            return cv2.GaussianBlur(src, (int(6 * radius + 1),) * 2, radius)
+        return cv2.bilateralFilter(src, -1, radius, radius)
+
+
+class FindContoursStep(Step):
+    def __init__(self, spec, threshold_mode):
+        Step.__init__(self, spec, 'find_contours', ('external_only',))
+
+    def run(self, src, shared):
+        mode = cv2.RETR_EXTERNAL if self.values['external_only'] else cv2.RETR_LIST
+        return cv2.findContours(src, mode=mode, method=cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+
+class FilterContoursStep(Step):
+    def __init__(self, spec, threshold_mode):
+        Step.__init__(self, spec, 'filter', FILTER_PARAMS)
+
+    def run(self, contours, shared):
+        p = self.values
+        return filter_contours(contours, p['min_area'], p['min_perimeter'], p['min_width'],
+                               p['max_width'], p['min_height'], p['max_height'], p['solidity'],
+                               p['max_vertices'], p['min_vertices'], p['min_ratio'],
+                               p['max_ratio'])
+
+
+STEPS = {
+    'threshold': ThresholdStep,
+    'blur': BlurStep,
+    'find_contours': FindContoursStep,
+    'filter_contours': FilterContoursStep,
+}
+
+
+class GripPipeline(object):
+    """Executes a compiled plan, same interface as the GRIP generated Pipeline"""
+    def __init__(self, plan, threshold_mode='convert'):
+        self.plan = plan
+        self.steps = [STEPS[spec['op']](spec, threshold_mode) for spec in plan['steps']]
+        self.inputs = [spec['input'] for spec in plan['steps']]
+        # Only thresholds take packed YUYV frames, other steps on the frame need BGR
+        self.needs_bgr = any(spec['input'] < 0 and spec['op'] != 'threshold'
+                             for spec in plan['steps'])
+        self.bgr = None
+        self.filter_contours_output = []
+        self.stage_times = ()
+
+    def downscale(self, factor):
+        """Rescale the size based parameters to run on a frame shrunk by factor"""
+        for step in self.steps:
+            step.downscale(factor)
+
+    def params(self):
+        """Tunable parameters by name, as they are being run"""
+        params = {}
+        for step in self.steps:
+            params.update(step.params())
+        return params
+
+    def set_params(self, params):
+        """Set tunable parameters by name, rescaled if downscale() was called"""
+        for step in self.steps:
+            step.set_params(params)
+
+    def process(self, source0, shared=None):
+        """Runs the pipeline and sets filter_contours_output
+
+        shared is a dict for one frame, passed to every pipeline running on that frame.
+        """
+        outputs = []
+        stage_times = []
+        if self.needs_bgr and yuyv.is_yuyv(source0):
+            if self.bgr is None or self.bgr.shape[:2] != source0.shape[:2]:
+                self.bgr = None  # Geometry changed, let the conversion allocate once
+            self.bgr = source0 = yuyv.to_bgr(source0, self.bgr)
+        for step, input_index in zip(self.steps, self.inputs):
+            t_start = perf_counter()
+            outputs.append(step.run(source0 if input_index < 0 else outputs[input_index], shared))
+            stage_times.append((step.name, perf_counter() - t_start))
+        self.filter_contours_output = outputs[self.plan['output']]
+        self.stage_times = tuple(stage_times)
+
+
+class MultiPipeline(object):
+    """Several plans on the same frame, sharing colour conversions, targets concatenated
+
+    Parameters are named <plan name>.<parameter>, e.g. gear.blur_radius.
+    """
+    def __init__(self, pipelines, names):
+        self.pipelines = pipelines
+        self.names = names
+        self.filter_contours_output = []
+        self.stage_times = ()
+
+    def downscale(self, factor):
+        for pipeline in self.pipelines:
+            pipeline.downscale(factor)
+
+    def params(self):
+        params = {}
+        for name, pipeline in zip(self.names, self.pipelines):
+            params.update(('{}.{}'.format(name, key), value)
+                          for key, value in pipeline.params().items())
+        return params
+
+    def set_params(self, params):
+        for name, pipeline in zip(self.names, self.pipelines):
+            prefix = name + '.'
+            pipeline.set_params({key[len(prefix):]: value for key, value in params.items()
+                                 if key.startswith(prefix)})
+
+    def process(self, source0):
+        shared = {}
+        output = []
+        stage_times = {}
+        for pipeline in self.pipelines:
+            pipeline.process(source0, shared)
+            output += pipeline.filter_contours_output
+            for name, seconds in pipeline.stage_times:
+                stage_times[name] = stage_times.get(name, 0.0) + seconds
+        self.filter_contours_output = output
+        self.stage_times = tuple(stage_times.items())
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+from threading import Event, Thread
+
+from tracker.affinity import place
+
+
+class IoLoop(Thread):
+    """Thread owning the asyncio loop that does all network I/O
+
+    Services are coroutine functions added before start(), each runs as a task until
+    shutdown(). Nothing on the loop ever waits on the vision threads, and they only hand
+    it work through thread safe calls. It runs where config places the io stage, as do the
+    threads it starts.
+    """
+    def __init__(self, config=None):
+        Thread.__init__(self, name='IO')
+        self.daemon = True
+        self.log = logging.getLogger('IO')
+        self.log.setLevel(logging.INFO)
+        self.services = []
+        self.loop = None
+        self.started = Event()
+        self.stop = None
+        self.config = config or {}
+
+    def add(self, service):
+        """Coroutine function, called with no arguments on the loop"""
+        self.services.append(service)
+
+    def shutdown(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop.set)
+
+    def run(self):
+        place(self.config, 'io', self.name)
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop = asyncio.Event()
+        tasks = [asyncio.ensure_future(service()) for service in self.services]
+        for task in tasks:
+            task.add_done_callback(self.report)
+        self.started.set()
+        await self.stop.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def report(self, task):
+        """Log a service that died, the others keep running"""
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error("Service failed: {!r}".format(task.exception()))
@@ -71,3 +71,34 @@ class MessageConfig:
 
     def getSaturation(self):
         return self.Saturation
+
+
+class MessageParser:
+    """Splits the RIO's byte stream into MessageConfig, one per line
+
+    A receive can hold several messages, or end part way through one, so the tail is kept
+    for the next feed().
+    """
+    MAX_PARTIAL = 4096  # A line this long without a newline is garbage
+
+    def __init__(self):
+        self.partial = b''
+        self.invalid = 0
+
+    def feed(self, data):
+        """Valid MessageConfig for every line completed by data, in order"""
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        if len(self.partial) > self.MAX_PARTIAL:
+            self.partial = b''
+            self.invalid += 1
+        messages = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                messages.append(MessageConfig(line.decode()))
+            except (ValueError, IndexError, UnicodeDecodeError):
+                self.invalid += 1
+        return messages
@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+
+from threading import Event, Lock, Thread
+
+
+def downscaled(name, value, factor):
+    """Size based parameter for a frame shrunk by factor, other parameters unchanged
+
+    Min limits are loosened by a pixel so candidates survive rounding. At factor 1 every
+    value is returned as is.
+    """
+    if factor == 1:
+        return value
+    if name.endswith('radius'):
+        return value / factor
+    if name.endswith('min_area'):
+        return value / factor ** 2
+    if name.endswith(('min_perimeter', 'min_width', 'min_height')):
+        return max(value / factor - 1, 0)
+    if name.endswith(('max_width', 'max_height')):
+        return value / factor + 1
+    return value
+
+
+def checked(name, value, default):
+    """value if it has the same shape as the default, throws ValueError"""
+    number = (int, float)
+    if isinstance(default, bool):
+        valid = isinstance(value, bool)
+    elif isinstance(default, (list, tuple)):
+        valid = (isinstance(value, (list, tuple)) and len(value) == len(default) and
+                 all(isinstance(v, number) and not isinstance(v, bool) for v in value))
+        value = list(value) if valid else value
+    else:
+        valid = isinstance(value, number) and not isinstance(value, bool)
+    if not valid:
+        raise ValueError("Parameter '{}' must be like {}, not {}".format(name, default, value))
+    return value
+
+
+class ParameterStore(object):
+    """Live pipeline parameters, workers pick up a change before their next frame
+
+    Holds the values changed from the pipeline's defaults. An update swaps in a new
+    (version, values) tuple, so readers never see half of one and never take the lock.
+    """
+    def __init__(self, defaults):
+        self.log = logging.getLogger('Params')
+        self.log.setLevel(logging.INFO)
+        self.defaults = defaults
+        self.lock = Lock()
+        self.current = (0, {})
+        self.loaded = set()  # Names set by the config file last time it was loaded
+
+    def update(self, changes):
+        """Validate and apply changes by name, throws ValueError and applies none"""
+        if not isinstance(changes, dict):
+            raise ValueError("Parameters must be a JSON object")
+        unknown = set(changes) - set(self.defaults)
+        if unknown:
+            raise ValueError("Unknown parameter(s) {}".format(', '.join(sorted(unknown))))
+        changes = {name: checked(name, value, self.defaults[name])
+                   for name, value in changes.items()}
+        with self.lock:
+            version, values = self.current
+            if all(values.get(name) == value for name, value in changes.items()):
+                return
+            values = dict(values)
+            values.update(changes)
+            self.current = (version + 1, values)
+        self.log.info("Version {}: {}".format(version + 1, changes))
+
+    def load(self, params):
+        """Parameters from the config file, any it no longer sets go back to their defaults
+
+        Pipelines only apply what they are sent, so the default is sent for those. Parameters
+        tuned over HTTP and never in the file are left alone. Throws ValueError.
+        """
+        if not isinstance(params, dict):
+            raise ValueError("Parameters must be a JSON object")
+        changes = {name: self.defaults[name] for name in self.loaded - set(params)
+                   if name in self.defaults}
+        changes.update(params)
+        self.update(changes)
+        self.loaded = set(params)
+
+    def effective(self):
+        """Every parameter with its value now"""
+        values = dict(self.defaults)
+        values.update(self.current[1])
+        return values
+
+
+class ConfigWatcher(Thread):
+    """Calls apply with a config file's contents whenever the file is saved"""
+    def __init__(self, path, apply, period=1.0):
+        Thread.__init__(self, name='ConfigWatcher')
+        self.daemon = True
+        self.log = logging.getLogger('Params')
+        self.path = path
+        self.apply = apply
+        self.period = period
+        self.stopped = Event()
+        self.mtime = self.modified()
+
+    def modified(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def shutdown(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.period):  # Poll: Cheap stat, no extra dependency
+            mtime = self.modified()
+            if mtime == self.mtime:
+                continue
+            self.mtime = mtime
+            try:
+                with open(self.path, 'r') as f:
+                    self.apply(json.load(f))
+            except (OSError, ValueError) as e:
+                self.log.warning("Ignoring {}: {}".format(self.path, e))
@@ -2,25 +2,42 @@ import cv2
 import numpy
 import math
 from enum import Enum
+from time import perf_counter
+
+from tracker.blur import binary_median
+from tracker.contours import filter_contours
+from tracker.params import downscaled
+from tracker.threshold import ColorThreshold
+
+# Tunable at run time, named as the attributes without their leading underscores
+PARAMS = ('hsl_threshold_hue', 'hsl_threshold_saturation', 'hsl_threshold_luminance',
+          'blur_radius', 'find_contours_external_only', 'filter_contours_min_area',
+          'filter_contours_min_perimeter', 'filter_contours_min_width',
+          'filter_contours_max_width', 'filter_contours_min_height',
+          'filter_contours_max_height', 'filter_contours_solidity',
+          'filter_contours_max_vertices', 'filter_contours_min_vertices',
+          'filter_contours_min_ratio', 'filter_contours_max_ratio')
 
 class Pipeline:
     """
     An OpenCV pipeline generated by GRIP.
     """
     
-    def __init__(self):
+    def __init__(self, threshold_mode='convert'):
         """initializes all values to presets or None if need to be set
         """
 
         self.__hsl_threshold_hue = [21.043165467625897, 100.13651877133105]
         self.__hsl_threshold_saturation = [100.0, 255.0]
         self.__hsl_threshold_luminance = [51.91546762589928, 255.0]
+        self.__hsl_threshold_stage = ColorThreshold(cv2.COLOR_BGR2HLS, threshold_mode)
 
         self.hsl_threshold_output = None
 
         self.__blur_input = self.hsl_threshold_output
         self.__blur_type = BlurType.Median_Filter
         self.__blur_radius = 38.73873873873874
+        self.__blur_input_binary = True  # Fed by the threshold, 0/255 only
 
         self.blur_output = None
 
@@ -44,41 +61,76 @@ class Pipeline:
 
         self.filter_contours_output = None
 
+        self.stage_times = ()
+        self.__scale = 1
+
+
+    def downscale(self, factor):
+        """Rescale the size based parameters to run on a frame shrunk by factor
+        """
+        self.__scale *= factor
+        for name in PARAMS:
+            setattr(self, '_Pipeline__' + name, downscaled(name, getattr(self, '_Pipeline__' + name), factor))
+
+    def params(self):
+        """Tunable parameters by name, as they are being run
+        """
+        return {name: getattr(self, '_Pipeline__' + name) for name in PARAMS}
+
+    def set_params(self, params):
+        """Set tunable parameters by name, rescaled if downscale() was called
+        Takes effect on the next process(), the threshold's lookup table is rebuilt only if its range changed.
+        """
+        for name, value in params.items():
+            if name in PARAMS:
+                setattr(self, '_Pipeline__' + name, downscaled(name, value, self.__scale))
 
     def process(self, source0):
         """
         Runs the pipeline and sets all outputs to new values.
         """
+        t_start = perf_counter()
         # Step HSL_Threshold0:
         self.__hsl_threshold_input = source0
-        (self.hsl_threshold_output) = self.__hsl_threshold(self.__hsl_threshold_input, self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
+        (self.hsl_threshold_output) = self.__hsl_threshold(self.__hsl_threshold_stage, self.__hsl_threshold_input, self.__hsl_threshold_hue, self.__hsl_threshold_saturation, self.__hsl_threshold_luminance)
+        t_threshold = perf_counter()
 
         # Step Blur0:
         self.__blur_input = self.hsl_threshold_output
-        (self.blur_output) = self.__blur(self.__blur_input, self.__blur_type, self.__blur_radius)
+        blur_type = self.__blur_type
+        if self.__blur_input_binary and blur_type is BlurType.Median_Filter:
+            blur_type = BlurType.Binary_Median  # Same result, much cheaper on a mask
+        (self.blur_output) = self.__blur(self.__blur_input, blur_type, self.__blur_radius)
+        t_blur = perf_counter()
 
         # Step Find_Contours0:
         self.__find_contours_input = self.blur_output
         (self.find_contours_output) = self.__find_contours(self.__find_contours_input, self.__find_contours_external_only)
+        t_find = perf_counter()
 
         # Step Filter_Contours0:
         self.__filter_contours_contours = self.find_contours_output
         (self.filter_contours_output) = self.__filter_contours(self.__filter_contours_contours, self.__filter_contours_min_area, self.__filter_contours_min_perimeter, self.__filter_contours_min_width, self.__filter_contours_max_width, self.__filter_contours_min_height, self.__filter_contours_max_height, self.__filter_contours_solidity, self.__filter_contours_max_vertices, self.__filter_contours_min_vertices, self.__filter_contours_min_ratio, self.__filter_contours_max_ratio)
+        t_filter = perf_counter()
+
+        self.stage_times = (('threshold', t_threshold - t_start), ('blur', t_blur - t_threshold),
+                            ('find_contours', t_find - t_blur), ('filter', t_filter - t_find))
 
 
     @staticmethod
-    def __hsl_threshold(input, hue, sat, lum):
+    def __hsl_threshold(stage, input, hue, sat, lum):
         """Segment an image based on hue, saturation, and luminance ranges.
         Args:
+            stage: The ColorThreshold holding the reused buffers.
             input: A BGR numpy.ndarray.
             hue: A list of two numbers the are the min and max hue.
             sat: A list of two numbers the are the min and max saturation.
             lum: A list of two numbers the are the min and max luminance.
         Returns:
-            A black and white numpy.ndarray.
+            A black and white numpy.ndarray, overwritten by the next frame.
         """
-        out = cv2.cvtColor(input, cv2.COLOR_BGR2HLS)
-        return cv2.inRange(out, (hue[0], lum[0], sat[0]),  (hue[1], lum[1], sat[1]))
+        stage.set_range((hue[0], lum[0], sat[0]),  (hue[1], lum[1], sat[1]))
+        return stage.apply(input)
 
     @staticmethod
     def __blur(src, type, radius):
@@ -99,6 +151,9 @@ class Pipeline:
         elif(type is BlurType.Median_Filter):
             ksize = int(2 * round(radius) + 1)
             return cv2.medianBlur(src, ksize)
+        elif(type is BlurType.Binary_Median):
+            ksize = int(2 * round(radius) + 1)
+            return binary_median(src, ksize)
         else:
             return cv2.bilateralFilter(src, -1, round(radius), round(radius))
 
@@ -116,7 +171,7 @@ class Pipeline:
         else:
             mode = cv2.RETR_LIST
         method = cv2.CHAIN_APPROX_SIMPLE
-        im2, contours, hierarchy =cv2.findContours(input, mode=mode, method=method)
+        contours = cv2.findContours(input, mode=mode, method=method)[-2]  # OpenCV 3 and 4
         return contours
 
     @staticmethod
@@ -140,30 +195,10 @@ class Pipeline:
         Returns:
             Contours as a list of numpy.ndarray.
         """
-        output = []
-        for contour in input_contours:
-            x,y,w,h = cv2.boundingRect(contour)
-            if (w < min_width or w > max_width):
-                continue
-            if (h < min_height or h > max_height):
-                continue
-            area = cv2.contourArea(contour)
-            if (area < min_area):
-                continue
-            if (cv2.arcLength(contour, True) < min_perimeter):
-                continue
-            hull = cv2.convexHull(contour)
-            solid = 100 * area / cv2.contourArea(hull)
-            if (solid < solidity[0] or solid > solidity[1]):
-                continue
-            if (len(contour) < min_vertex_count or len(contour) > max_vertex_count):
-                continue
-            ratio = (float)(w) / h
-            if (ratio < min_ratio or ratio > max_ratio):
-                continue
-            output.append(contour)
-        return output
-
-
-BlurType = Enum('BlurType', 'Box_Blur Gaussian_Blur Median_Filter Bilateral_Filter')
+        return filter_contours(input_contours, min_area, min_perimeter, min_width, max_width,
+                               min_height, max_height, solidity, max_vertex_count, min_vertex_count,
+                               min_ratio, max_ratio)
+
+
+BlurType = Enum('BlurType', 'Box_Blur Gaussian_Blur Median_Filter Bilateral_Filter Binary_Median')
 
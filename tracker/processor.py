@@ -1,111 +1,430 @@
 import cv2
 import logging
+import numpy as np
 
-from queue import Empty
-from threading import Thread
+from functools import partial
+from queue import Empty, Full
+from threading import Event, Lock, Thread
 from time import sleep, time
 
+from tracker.affinity import place, set_cv_threads
+from tracker.camera import camera_configs, expected_shape
 from tracker.com_rio import NetworkClient
-from tracker.com_video import CamHandler, stream_queue, ThreadedHTTPServer
+from tracker.com_video import SnapshotStream, VideoServer
+from tracker.governor import LADDER, PerformanceGovernor
+from tracker.grip import load_pipeline
+from tracker.io_loop import IoLoop
+from tracker.params import ConfigWatcher, ParameterStore
 from tracker.pipeline import Pipeline
-from tracker.util import CircularBuffer
+from tracker.protocol import make_encoder
+from tracker.pyramid import PyramidPipeline
+from tracker.roi import crop, offset_contours, RoiTracker
+from tracker.tracking import TargetTracker
+from tracker.trace import BUCKETS, FrameTrace, Metrics
+from tracker.util import WindowedStats
+from tracker.yuyv import align, is_yuyv
 
 
-def processing_process(config, queue):
-    """Process main - Vision Processing via GRIP Pipeline"""
+def processing_process(config, cameras):
+    """Process main - Vision Processing via GRIP Pipeline
+
+    cameras is a (config, ring, queue, control) per camera, each gets its own TargetProcessor
+    and workers so a slow camera only costs itself frames. Results share the RIO link, camera
+    settings sent by the RIO are forwarded on control to the camera process.
+    """
     log = logging.getLogger('Processing')
     log.setLevel(logging.INFO)
     video = config['video'] == 1
+    set_cv_threads(config.get('cv_threads', -1), 'Processing')
 
+    io = IoLoop(config)
     com = NetworkClient(config)
-    processor = TargetProcessor(queue)
-    processor.register(com, stream_queue)
-    com.start()
-    processor.start()
-
+    io.add(com.run)
+    com.on_config = partial(forward_config, [[c['src'], control] for c, _, _, control in cameras],
+                            log)
+    metrics = Metrics()
+    metrics.counter('messages_sent', lambda: com.sent)
+    metrics.counter('messages_dropped', lambda: com.dropped)
+    metrics.counter('messages_coalesced', lambda: com.coalesced)
+    processors = []
+    streams = {}
+    for camera_config, ring, queue, _ in cameras:
+        processor = TargetProcessor(ring, queue, camera_config, metrics)
+        stream = SnapshotStream(metrics, camera_config)
+        processor.register(com, stream)
+        processors.append(processor)
+        streams[processor.camera_id] = (stream, processor.params)
     if video:
-        stream = ThreadedHTTPServer(('localhost', 8080), CamHandler)
-        stream.queue = stream_queue
+        io.add(VideoServer(('localhost', 8080), metrics, streams).run)
+    watcher = None
+    if config.get('config_path') is not None:
+        watcher = ConfigWatcher(config['config_path'], partial(apply_params, processors))
+        watcher.start()
+    io.start()
+    io.started.wait()
+    for processor in processors:
+        processor.start()
 
     try:
-        if video:
-            stream.serve_forever()
         while True:
             sleep(100)
     except KeyboardInterrupt:
         log.info("Shutting down")
-        if video:
-            stream.shutdown()
     finally:
-        queue.close()
-        queue.join_thread()
-        com.shutdown()
-        com.join()
+        for _, _, queue, _ in cameras:
+            queue.close()
+            queue.join_thread()
+
+        for processor in processors:
+            processor.shutdown()
+        for processor in processors:
+            processor.join()
+        io.shutdown()
+        io.join()
+        if watcher is not None:
+            watcher.shutdown()
+
+
+def forward_config(controls, log, message):
+    """Pass a MessageConfig to the camera without waiting, it only needs the newest
+
+    controls is a [source, control] per camera. It goes to the camera already on its source,
+    else the first camera switches to it, and is on that source from then on. MessageConfig
+    has no camera id, the source is all there is to go by.
+    """
+    entry = next((e for e in controls if e[0] == message.Source), controls[0])
+    try:
+        entry[1].put_nowait(message)
+    except Full:
+        log.warning("Camera is not taking settings, dropped {}".format(vars(message)))
+        return
+    entry[0] = message.Source
+
+
+def apply_params(processors, config):
+    """Pipeline parameters from a reloaded config file"""
+    for camera_config, processor in zip(camera_configs(config), processors):
+        processor.params.load(camera_config.get('params', {}))
 
-        processor.shutdown()
-        processor.join()
-        if video:
-            stream.server_close()
 
 class TargetProcessor(Thread):
-    """Image process each frame, detects targets, push to consumer(s)"""
-    def __init__(self, queue):
-        Thread.__init__(self)
+    """Image process each frame, detects targets, push to consumer(s)
+
+    Frames are spread over a pool of PipelineWorker threads, OpenCV releases the GIL so
+    each one gets a core. Results are put back in capture order, or only the newest kept.
+    """
+    def __init__(self, ring, queue, config, metrics=None):
+        self.camera_id = config.get('id', 0)
+        label = config.get('label', '')
+        Thread.__init__(self, name='Processor' + label)
         self.daemon = True
+        self.log = logging.getLogger('Processor' + label)
+        self.log.setLevel(logging.INFO)
+        self.ring = ring
         self.rx_queue = queue
-        self.pipeline = Pipeline() # Grip pipeline
-        self.fps = CircularBuffer(15)
         self.time_last = time() - .001
         self.running = True
+        self.stopped = Event()
+        self.dispatch_lock = Lock()
+        self.sequence = 0
+        self.reorder = ResultReorder(config.get('order', 'capture'), self.emit)
+        self.encoder = make_encoder(config)  # Only used from emit(), which is serialised
+        self.prefix = label + '_' if label else ''  # Tells cameras apart in shared metrics
+        self.metrics = Metrics() if metrics is None else metrics
+        self.metrics.counter(self.prefix + 'frames_dropped', lambda: ring.dropped)
+        self.metrics.counter(self.prefix + 'results_dropped', lambda: self.reorder.dropped)
+        self.window = config.get('stats_window', 60)  # Frames the recent figures cover
+        self.interval = WindowedStats(self.window, BUCKETS)  # Between results, for fps
+        self.metrics.window(self.prefix + 'interval', self.interval)
+        self.stages = {}  # Stage name to its WindowedStats, added as stages are first seen
+        self.roi = None
+        if config.get('roi', 0) == 1:
+            self.roi = RoiTracker(config.get('roi_pad', 80), config.get('roi_confirm', 2),
+                                  config.get('roi_full_interval', 30))
+        self.roi_pad = config.get('roi_pad', 80)
+        self.tracker = None  # Only used from emit(), in output order
+        if config.get('tracking', 0) == 1:
+            self.tracker = TargetTracker(config.get('track_gate', 60.0),
+                                         config.get('track_coast', 2),
+                                         config.get('track_process_noise', 2000.0),
+                                         config.get('track_measurement_noise', 3.0))
+        self.predict_ahead = config.get('predict_ahead', 0.0)  # Seconds past transmit
+        self.governor = None  # Only used from emit()
+        if config.get('deadline_ms', 0) > 0:
+            self.governor = PerformanceGovernor(config['deadline_ms'] / 1000.0,
+                                                config.get('quality_ladder', LADDER),
+                                                name=label)
+        self.quality = (0, {})  # Version, governor's settings. Swapped whole, like params
+        self.skip = 0
+        self.received = 0
+        self.skipped = 0
+        self.metrics.counter(self.prefix + 'frames_skipped', lambda: self.skipped)
+        self.pyramid_scale = config.get('pyramid_scale', 1)
+        self.threshold_mode = config.get('threshold_mode', 'convert')
+        self.pipeline = config.get('pipeline', 'builtin')
+        self.config = config  # Where its threads run, see affinity.place
+        self.workers = [PipelineWorker(self, index) for index in range(config.get('workers', 1))]
+        self.params = ParameterStore(self.workers[0].pipeline.params())
+        self.params.load(config.get('params', {}))
+        self.report_period = 10.0
+        self.warmup_frame = np.zeros(expected_shape(config), dtype=np.uint8)
+        self.t_started = time()
+        self.first_target = None  # Seconds from start to the first target sent
 
-    def register(self, com, queue_stream):
-        """Communication object to receive output data"""
+    def register(self, com, stream):
+        """Communication object to receive output data, stream to show processed frames"""
         self.com = com
-        self.stream = queue_stream
+        self.stream = stream
+        self.stream_period = stream.period
 
     def shutdown(self):
         self.running = False
+        self.stopped.set()
+
+    def run(self):
+        """Start the workers, report how busy they are"""
+        self.log.info("Starting {} worker(s), {} order".format(len(self.workers),
+                                                               self.reorder.mode))
+        for worker in self.workers:
+            worker.start()
+        place(self.config, 'io', self.name)  # Only reports, kept off the workers' cores
+        while not self.stopped.wait(self.report_period):
+            self.log.info("Worker utilisation: {}, results dropped: {}".format(
+                ', '.join('{:.0%}'.format(w.utilisation()) for w in self.workers),
+                self.reorder.dropped))
+            if 'total' in self.stages:
+                latency = self.stages['total'].snapshot()
+                self.log.info("{} fps, latency p50 {:.1f}ms p95 {:.1f}ms p99 {:.1f}ms".format(
+                    self.fps(), 1000.0 * latency['p50'], 1000.0 * latency['p95'],
+                    1000.0 * latency['p99']))
+        for worker in self.workers:
+            worker.join()
+
+    def make_pipeline(self, scale=None):
+        """Grip pipeline for one worker, searching frames shrunk by scale first if over 1"""
+        scale = self.pyramid_scale if scale is None else scale
+        if self.pipeline == 'builtin':
+            factory = partial(Pipeline, threshold_mode=self.threshold_mode)
+        else:  # .grip file(s)
+            factory = partial(load_pipeline, self.pipeline, threshold_mode=self.threshold_mode)
+        if scale > 1:
+            return PyramidPipeline(factory, scale)
+        return factory()
+
+    def next_frame(self):
+        """Next slot from the camera with its dispatch order, throws Empty: Disconnected"""
+        with self.dispatch_lock:
+            while True:
+                slot = self.rx_queue.get(True, timeout=.1)  # Block: Ahead of camera
+                if not self.ring.take(slot):
+                    continue  # Camera restarted, the slot went back with its others
+                self.received += 1
+                if self.skip and self.received % self.skip == 0:  # Governor shedding load
+                    self.ring.release(slot)
+                    self.skipped += 1
+                    continue
+                self.sequence += 1
+                return self.sequence, slot
+
+    def process(self, pipeline, frame, trace):
+        """Run pipeline on frame, returns its result for emit()"""
+        window = None if self.roi is None else self.roi.window(frame.shape)
+        if window is None:
+            pipeline.process(frame)
+            contours = pipeline.filter_contours_output
+        else:  # Tracking: only search near the last targets
+            if is_yuyv(frame):
+                window = align(window, frame.shape)
+            pipeline.process(crop(frame, window))
+            contours = offset_contours(pipeline.filter_contours_output, *window[:2])
+        frame_h, frame_w, _ = frame.shape
+        center_x = frame_w / 2.0
+        center_y = frame_h / 2.0
+
+        # Calculate the dimensions of the bounding rectangles
+        # http://docs.opencv.org/3.1.0/dd/d49/tutorial_py_contour_features.html
+        rects = [cv2.boundingRect(contour) for contour in contours]
+        if self.roi is not None:
+            self.roi.update(rects, window)
+
+        targets = []
+        for pixel_x, pixel_y, pixel_w, pixel_h in rects:
+            percent_x = (pixel_x - center_x) / center_x  # -1 to 1
+            percent_y = (pixel_y - center_y) / center_y  # -1 to 1
+            targets.append((percent_x, percent_y, pixel_w, pixel_h))
+
+        snapshot = None
+        if not self.stream.full():
+            snapshot = self.stream.shrink(frame)  # Slot is reused once released
+        trace.steps = pipeline.stage_times
+        trace.mark('process')
+        return trace, frame_w, frame_h, targets, rects, snapshot
+
+    def emit(self, result):
+        """Push one frame's targets to consumer(s), called in output order"""
+        trace, frame_w, frame_h, targets, rects, snapshot = result
+        trace.mark('reorder')
+        t_taken = trace.events[0][1]
+
+        now = time()
+        self.interval.add(now - self.time_last)
+        self.time_last = now
+        if self.tracker is not None:  # Projected to when the RIO gets them
+            self.tracker.update(rects, t_taken)
+            targets = self.tracker.targets(now + self.predict_ahead, frame_w, frame_h)
+            trace.mark('track')
+        if self.governor is not None:
+            t_processed = next(t for event, t in trace.events if event == 'process')
+            quality = self.governor.observe(t_processed - t_taken)
+            if quality is not None:
+                self.set_quality(quality)
+
+        coprocessor_data = self.encoder.encode(
+            trace.frame_id,
+            t_taken,
+            (time() - t_taken) * 1000.0,
+            frame_w,
+            frame_h,
+            self.fps(),
+            targets,
+        )
+        trace.mark('serialise')
+        self.com.transmit(coprocessor_data, self.camera_id)
+        trace.mark('transmit')
+        if self.first_target is None and targets:
+            self.first_target = time() - self.t_started
+            self.log.info("First target {:.2f}s after start".format(self.first_target))
+        self.metrics.record(trace, self.prefix)
+        self.record_window(trace)
+        if snapshot is not None and not self.stream.full():
+            self.stream.put(snapshot, rects, frame_w)
+
+    def set_quality(self, quality):
+        """Apply a governor level, workers pick up their part before their next frame"""
+        if self.roi is not None:
+            self.roi.pad = int(self.roi_pad * quality.get('roi_pad', 1))
+        self.stream.period = self.stream_period / quality.get('stream_rate', 1)
+        self.skip = quality.get('skip', 0)
+        self.quality = (self.quality[0] + 1, quality)
+
+    def pipeline_params(self, values, quality):
+        """Every parameter for workers to set, params changed by values, degraded by quality"""
+        blur = quality.get('blur', 1)
+        params = dict(self.params.defaults)
+        params.update(values)
+        return {name: value * blur if name.endswith('radius') else value
+                for name, value in params.items()}
+
+    def fps(self):
+        """Result rate over the recent window"""
+        interval = self.interval.mean
+        return round(1.0 / interval, 1) if interval > 0 else 0.0
+
+    def record_window(self, trace):
+        """Add the frame's stage times to the recent figures"""
+        for stage, seconds in trace.stages():
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = WindowedStats(self.window, BUCKETS)
+                self.metrics.window(self.prefix + stage, stats)
+            stats.add(seconds)
+
+
+class PipelineWorker(Thread):
+    """Runs its own GRIP pipeline on frames pulled from the camera"""
+    def __init__(self, processor, index):
+        Thread.__init__(self, name='{}Worker{}'.format(processor.prefix, index))
+        self.daemon = True
+        self.processor = processor
+        self.pipeline = processor.make_pipeline()
+        self.scale = processor.pyramid_scale
+        self.params_version = 0
+        self.quality_version = 0
+        self.busy = 0.0  # Only this worker writes, total seconds spent processing
+        self.busy_report = 0.0
+        self.time_report = time()
+
+    def utilisation(self):
+        """Fraction of time spent processing since last called"""
+        now = time()
+        busy = self.busy
+        elapsed = now - self.time_report
+        utilisation = (busy - self.busy_report) / elapsed
+        self.busy_report, self.time_report = busy, now
+        return utilisation
 
     def run(self):
         """Process frame for targets"""
-        while self.running:
-            if self.rx_queue.empty():
-                sleep(0) # Yield: Ahead of camera
-                continue
-
-            targets = ''
-            num_targets = 0
-            frame, t_taken = self.rx_queue.get(True, timeout=.1) # Throws Empty: Disconnected
-
-            now = time()
-            delta = now - self.time_last
-            self.fps.append(1.0 / delta)
-            self.time_last = now
-
-            self.pipeline.process(frame)
-            frame_h, frame_w, _ = frame.shape
-            center_x = frame_w / 2.0
-            center_y = frame_h / 2.0
-
-            # Calculate the dimensions of the bounding rectangles
-            # http://docs.opencv.org/3.1.0/dd/d49/tutorial_py_contour_features.html
-
-            # Concatenation reasoning - https://waymoot.org/home/python_string/
-            for index, contour in enumerate(self.pipeline.filter_contours_output):
-                pixel_x, pixel_y, pixel_w, pixel_h = cv2.boundingRect(contour)
-                percent_x = (pixel_x - center_x) / center_x  # -1 to 1
-                percent_y = (pixel_y - center_y) / center_y  # -1 to 1
-                targets += "{},{},{},{},".format( percent_x, percent_y, pixel_w, pixel_h)
-                num_targets += 1
-
-            coprocessor_data = "{},{},{},{},{},{}\n".format(
-                (time() - t_taken) * 1000.0,
-                frame_w,
-                frame_h,
-                self.fps.get_average(1),
-                num_targets,
-                targets,
-            )
-            self.com.transmit(coprocessor_data)
-            if not self.stream.full():
-                self.stream.put(frame)
+        processor = self.processor
+        ring = processor.ring
+        place(processor.config, 'worker', self.name)
+        t_start = time()
+        self.pipeline.process(processor.warmup_frame)  # First call allocations, before frames
+        processor.log.info("{} warmed up in {:.0f}ms".format(self.name,
+                                                             1000.0 * (time() - t_start)))
+        while processor.running:
+            try:
+                sequence, slot = processor.next_frame()
+            except Empty:
+                continue  # Disconnected, recheck running
+            t_start = time()
+            version, values = processor.params.current
+            quality_version, quality = processor.quality
+            if quality_version != self.quality_version:  # Governor changed level
+                scale = processor.pyramid_scale * quality.get('downscale', 1)
+                if scale != self.scale:
+                    self.pipeline = processor.make_pipeline(scale)
+                    self.scale = scale
+                self.pipeline.set_params(processor.pipeline_params(values, quality))
+                self.params_version, self.quality_version = version, quality_version
+            elif version != self.params_version:  # Tuned since the last frame
+                self.pipeline.set_params(processor.pipeline_params(values, quality)
+                                         if quality else values)
+                self.params_version = version
+            result = None
+            try:
+                trace = FrameTrace(*ring.stamps(slot))
+                trace.mark('dequeue')
+                frame = ring.frame(slot)  # Taken in next_frame()
+                result = processor.process(self.pipeline, frame, trace)
+            except Exception:  # One bad frame must not stop the worker
+                processor.log.exception("Frame {} failed".format(sequence))
+            finally:
+                ring.release(slot)
+                processor.reorder.submit(sequence, result)  # Even on failure, or order stalls
+                self.busy += time() - t_start
+
+
+class ResultReorder(object):
+    """Puts results from parallel workers back in dispatch order
+
+    'capture' emits every result in order, holding early finishers back.
+    'newest' emits as soon as a result arrives and drops any older than the last emitted.
+    """
+    def __init__(self, mode, emit):
+        if mode not in ('capture', 'newest'):
+            raise ValueError("Unknown result order '{}'".format(mode))
+        self.mode = mode
+        self.emit = emit
+        self.lock = Lock()
+        self.pending = {}
+        self.last = 0
+        self.dropped = 0
+
+    def submit(self, sequence, result):
+        """Result of frame number sequence, None if it failed"""
+        with self.lock:
+            if self.mode == 'newest':
+                if sequence < self.last:
+                    self.dropped += 1
+                    return
+                self.last = sequence
+                if result is not None:
+                    self.emit(result)
+                return
+            self.pending[sequence] = result
+            while self.last + 1 in self.pending:
+                self.last += 1
+                result = self.pending.pop(self.last)
+                if result is not None:
+                    self.emit(result)
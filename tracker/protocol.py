@@ -0,0 +1,80 @@
+"""Target messages to the RIO, one per frame
+
+'csv' is the original text line:
+    latency_ms,width,height,fps,count,x,y,w,h,x,y,w,h,...\n
+with several cameras it starts with the camera id:
+    id,latency_ms,width,height,fps,count,x,y,w,h,...\n
+with tracking on each target is led by its track id and followed by its velocity:
+    latency_ms,width,height,fps,count,track,x,y,w,h,vx,vy,...\n
+
+'binary' is little endian, a fixed header then count fixed size target records:
+    header  magic b'TT', version u8, camera id u8, frame id u32, capture time f64 (epoch s),
+            latency_ms f32, width u16, height u16, fps f32, count u16            30 bytes
+    target  x f32, y f32 (-1 to 1 from the image centre), w u16, h u16 (pixels)  12 bytes
+A message is 30 + 12 * count bytes, so a stream reader knows its length from the header.
+With tracking on the version is 2 and targets are 24 bytes, positions projected forward:
+    target  x f32, y f32, w u16, h u16, vx f32, vy f32 (per second), track id u16, 2 pad
+"""
+import struct
+
+
+VERSION = 1
+TRACKED_VERSION = 2
+MAGIC = b'TT'
+HEADER = struct.Struct('<2sBBIdfHHfH')
+TARGET = struct.Struct('<ffHH')
+TRACKED_TARGET = struct.Struct('<ffHHffH2x')
+MAX_TARGETS = 64  # More are dropped, keeps a message well inside one UDP datagram
+
+
+def make_encoder(config):
+    """Encoder for config's "protocol", 'csv' by default"""
+    protocol = config.get('protocol', 'csv')
+    tracked = config.get('tracking', 0) == 1
+    if protocol == 'csv':
+        return CsvEncoder(config.get('id', 0) if config.get('label') else None, tracked)
+    if protocol == 'binary':
+        return BinaryEncoder(config.get('id', 0), tracked)
+    raise ValueError("Unknown protocol '{}'".format(protocol))
+
+
+class CsvEncoder(object):
+    def __init__(self, camera_id=None, tracked=False):
+        self.tag = '' if camera_id is None else '{},'.format(camera_id)
+        self.tracked = tracked
+
+    def encode(self, frame_id, t_taken, latency_ms, width, height, fps, targets):
+        """Message bytes, targets is a sequence of (x, y, w, h), or (x, y, w, h, vx, vy, id)"""
+        fields = [self.tag, "{},{},{},{},{},".format(latency_ms, width, height, fps, len(targets))]
+        for target in targets:
+            if self.tracked:
+                fields.append("{6},{0},{1},{2},{3},{4},{5},".format(*target))
+            else:
+                fields.append("{},{},{},{},".format(*target))
+        fields.append("\n")
+        return ''.join(fields).encode()
+
+
+class BinaryEncoder(object):
+    """Packs into one preallocated buffer, the returned view is valid until the next encode()"""
+    def __init__(self, camera_id=0, tracked=False):
+        self.camera_id = camera_id
+        if tracked:
+            self.version, self.target = TRACKED_VERSION, TRACKED_TARGET
+        else:
+            self.version, self.target = VERSION, TARGET
+        self.buffer = bytearray(HEADER.size + MAX_TARGETS * self.target.size)
+        self.view = memoryview(self.buffer)
+
+    def encode(self, frame_id, t_taken, latency_ms, width, height, fps, targets):
+        """Message bytes, targets is a sequence of (x, y, w, h), or (x, y, w, h, vx, vy, id)"""
+        count = min(len(targets), MAX_TARGETS)
+        HEADER.pack_into(self.buffer, 0, MAGIC, self.version, self.camera_id,
+                         frame_id & 0xFFFFFFFF, t_taken, latency_ms, width, height, fps, count)
+        offset = HEADER.size
+        for target in targets[:count]:
+            if self.version == TRACKED_VERSION:  # Track ids wrap like frame ids
+                target = target[:6] + (target[6] & 0xFFFF,)
+            self.target.pack_into(self.buffer, offset, *target)
+            offset += self.target.size
+        return self.view[:offset]
@@ -0,0 +1,113 @@
+from time import perf_counter
+
+import cv2
+
+from tracker import yuyv
+from tracker.roi import crop, offset_contours, pad_rect
+
+
+def add_times(totals, stage_times):
+    """Accumulate a pipeline's stage_times by stage name"""
+    for name, seconds in stage_times:
+        totals[name] = totals.get(name, 0.0) + seconds
+
+
+def merge_rects(rects):
+    """Combine overlapping rects so no area is refined twice"""
+    merged = list(rects)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                if overlap(merged[i], merged[j]):
+                    merged[i] = union(merged[i], merged.pop(j))
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+def overlap(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def union(a, b):
+    x0 = min(a[0], b[0])
+    y0 = min(a[1], b[1])
+    return x0, y0, max(a[0] + a[2], b[0] + b[2]) - x0, max(a[1] + a[3], b[1] + b[3]) - y0
+
+
+def blur_reach(params):
+    """Pixels the largest blur radius among params reaches past a window's edge"""
+    return max([int(round(value)) for name, value in params.items() if name.endswith('radius')],
+               default=0)
+
+
+class PyramidPipeline(object):
+    """Coarse to fine: detect on a downscaled frame, refine the candidates at full resolution
+
+    The coarse pipeline runs with its size parameters rescaled. Each surviving candidate is
+    mapped back up, padded, and the full resolution pipeline runs only inside it. Output is
+    the same filter_contours_output a plain Pipeline gives. Windows are padded by pad plus the
+    fine pipeline's blur radius, so a median or box blur sees what it would on the whole frame.
+    """
+    def __init__(self, make_pipeline, scale, pad=16):
+        self.scale = scale
+        self.pad = pad
+        self.coarse = make_pipeline()
+        self.coarse.downscale(scale)
+        self.fine = make_pipeline()
+        self.reach = blur_reach(self.fine.params())
+        self.small = None
+        self.filter_contours_output = []
+        self.stage_times = ()
+
+    def params(self):
+        return self.fine.params()
+
+    def set_params(self, params):
+        """Both levels, the coarse one keeps its rescaling"""
+        self.coarse.set_params(params)
+        self.fine.set_params(params)
+        self.reach = blur_reach(self.fine.params())
+
+    def process(self, source0):
+        """Runs the pipeline and sets filter_contours_output in full frame pixels"""
+        t_start = perf_counter()
+        frame_h, frame_w = source0.shape[:2]
+        size = (max(frame_w // self.scale, 1), max(frame_h // self.scale, 1))
+        packed = yuyv.is_yuyv(source0)
+        if packed:
+            size = (max(size[0] & ~1, 2), size[1])  # Whole pixel pairs
+        if (self.small is None or self.small.shape[1::-1] != size or
+                self.small.shape[2:] != source0.shape[2:]):
+            self.small = None  # Geometry changed, let resize allocate once
+        if packed:
+            self.small = yuyv.resize(source0, size, dst=self.small)
+        else:
+            self.small = cv2.resize(source0, size, dst=self.small, interpolation=cv2.INTER_AREA)
+        stage_times = {'resize': perf_counter() - t_start}
+        self.coarse.process(self.small)
+        add_times(stage_times, self.coarse.stage_times)
+
+        scale_x = frame_w / size[0]
+        scale_y = frame_h / size[1]
+        windows = []
+        for contour in self.coarse.filter_contours_output:
+            x, y, w, h = cv2.boundingRect(contour)
+            rect = (int(x * scale_x), int(y * scale_y),
+                    int(round(w * scale_x)), int(round(h * scale_y)))
+            windows.append(pad_rect(rect, self.pad + self.reach + self.scale,
+                                    source0.shape))
+
+        output = []
+        for window in merge_rects(windows):
+            if packed:
+                window = yuyv.align(window, source0.shape)
+            self.fine.process(crop(source0, window))
+            add_times(stage_times, self.fine.stage_times)
+            output += offset_contours(self.fine.filter_contours_output, *window[:2])
+        self.filter_contours_output = output
+        self.stage_times = tuple(stage_times.items())
@@ -0,0 +1,174 @@
+"""Record captured frames to disk and replay them as a camera
+
+A recording is an append-only raw file, each frame a 32 byte record header followed by its
+pixels, so a reader can memory map it and use frames in place:
+    magic b'FRAM', frame id u64, capture time f64 (epoch s), height u16, width u16,
+    channels u16, 6 bytes padding                                               32 bytes
+Frames are as the pipeline saw them, after rotation.
+"""
+import logging
+import mmap
+import os
+
+from queue import Empty, Queue
+from threading import Thread
+from time import sleep, strftime, time
+
+import cv2
+import numpy as np
+
+
+RECORD = np.dtype([
+    ('magic', 'S4'),
+    ('frame_id', '<u8'),
+    ('t_taken', '<f8'),
+    ('height', '<u2'),
+    ('width', '<u2'),
+    ('channels', '<u2'),
+    ('pad', 'V6'),
+])
+MAGIC = b'FRAM'
+
+
+class Recorder(Thread):
+    """Writes frames from a separate thread so recording never slows capture
+
+    record() copies the frame into one of a few preallocated buffers and returns. When the
+    disk falls behind and none are free the frame is skipped and counted, capture goes on.
+    """
+    def __init__(self, directory, name='match', frame_bytes=0, buffers=8):
+        Thread.__init__(self, name='Recorder')
+        self.daemon = True
+        self.log = logging.getLogger('Recorder')
+        self.log.setLevel(logging.INFO)
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, '{}-{}.raw'.format(name, strftime('%Y%m%d-%H%M%S')))
+        self.free = Queue()
+        self.full = Queue()
+        for _ in range(buffers):
+            self.free.put(bytearray(RECORD.itemsize + frame_bytes))
+        self.skipped = 0
+        self.written = 0
+
+    def record(self, frame, frame_id, t_taken):
+        """Queue a copy of frame for writing, returns at once"""
+        try:
+            buffer = self.free.get_nowait()
+        except Empty:
+            self.skipped += 1
+            return
+        size = RECORD.itemsize + frame.nbytes
+        if len(buffer) < size:
+            buffer = bytearray(size)  # Grows once per resolution
+        header = np.frombuffer(buffer, RECORD, 1)
+        header[0] = (MAGIC, frame_id, t_taken, frame.shape[0], frame.shape[1],
+                     frame.shape[2] if frame.ndim > 2 else 1, b'')
+        pixels = np.frombuffer(buffer, np.uint8, frame.nbytes, RECORD.itemsize)
+        np.copyto(pixels.reshape(frame.shape), frame)
+        self.full.put((buffer, size))
+
+    def shutdown(self):
+        self.full.put(None)
+
+    def run(self):
+        """Thread main - Append queued frames to the file"""
+        self.log.info("Recording to {}".format(self.path))
+        with open(self.path, 'ab') as f:
+            while True:
+                item = self.full.get()  # Block: Until capture records a frame
+                if item is None:
+                    break
+                buffer, size = item
+                f.write(memoryview(buffer)[:size])
+                self.written += 1
+                self.free.put(buffer)
+        self.log.info("Stopped, {} frames written, {} skipped".format(self.written,
+                                                                      self.skipped))
+
+
+def read_recording(path):
+    """(header, frame) of every frame in a recording, frames are read only views of the file"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    frames = []
+    offset = 0
+    while offset + RECORD.itemsize <= len(data):
+        header = np.frombuffer(data, RECORD, 1, offset)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError("{} is corrupt at byte {}".format(path, offset))
+        shape = (int(header['height']), int(header['width']), int(header['channels']))
+        size = shape[0] * shape[1] * shape[2]
+        offset += RECORD.itemsize
+        if size == 0 or offset + size > len(data):
+            break  # Cut short by a crash, keep what is whole
+        frames.append((header, np.frombuffer(data, np.uint8, size, offset).reshape(shape)))
+        offset += size
+    return frames
+
+
+class ReplaySource(object):
+    """Plays a recording through the cv2.VideoCapture calls camera_process makes
+
+    'realtime' delivers frames with their recorded spacing, 'fast' as quickly as they are
+    taken. Settings can't change a recording, set() is ignored.
+    """
+    def __init__(self, path, pace='realtime'):
+        if pace not in ('realtime', 'fast'):
+            raise ValueError("Unknown replay pace '{}'".format(pace))
+        self.pace = pace
+        try:
+            self.frames = read_recording(path)
+        except (OSError, ValueError) as e:
+            logging.getLogger('Replay').error(e)
+            self.frames = []
+        self.index = -1
+        self.t_start = None
+
+    def isOpened(self):
+        return bool(self.frames)
+
+    def get(self, prop):
+        if not self.frames:
+            return 0
+        frame = self.frames[max(self.index, 0)][1]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return frame.shape[0]
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return frame.shape[1]
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.frames)
+        return 0
+
+    def set(self, prop, value):
+        return False
+
+    def grab(self):
+        """Advance to the next frame, at its recorded time when realtime. False at the end"""
+        self.index += 1
+        if self.index >= len(self.frames):
+            return False
+        if self.pace == 'realtime':
+            t_recorded = self.frames[self.index][0]['t_taken'] - self.frames[0][0]['t_taken']
+            if self.t_start is None:
+                self.t_start = time()
+            delay = t_recorded - (time() - self.t_start)
+            if delay > 0:
+                sleep(delay)  # Block: Recorded frame interval
+        return True
+
+    def retrieve(self, image=None):
+        frame = self.frames[self.index][1]
+        if image is not None and image.shape == frame.shape:
+            np.copyto(image, frame)
+            return True, image
+        return True, frame
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def release(self):
+        self.frames = []
@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def union_rect(rects):
+    """Smallest (x, y, w, h) containing all rects"""
+    x0 = min(x for x, _, _, _ in rects)
+    y0 = min(y for _, y, _, _ in rects)
+    x1 = max(x + w for x, _, w, _ in rects)
+    y1 = max(y + h for _, y, _, h in rects)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def pad_rect(rect, pad, frame_shape):
+    """Grow rect by pad pixels on every side, clipped to the frame"""
+    x, y, w, h = rect
+    frame_h, frame_w = frame_shape[:2]
+    x0 = max(x - pad, 0)
+    y0 = max(y - pad, 0)
+    x1 = min(x + w + pad, frame_w)
+    y1 = min(y + h + pad, frame_h)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def crop(frame, rect):
+    """View of frame inside rect, no copy"""
+    x, y, w, h = rect
+    return frame[y:y + h, x:x + w]
+
+
+def offset_contours(contours, x, y):
+    """Map contours found in a window back to full frame pixels"""
+    if x == 0 and y == 0:
+        return contours
+    offset = np.array((x, y), dtype=np.int32)
+    return [contour + offset for contour in contours]
+
+
+class RoiTracker(object):
+    """Picks the window to search next: near the last targets while they are being found
+
+    Searches the full frame until targets are seen on confirm frames in a row, then only a
+    window padded around them. Goes back to the full frame as soon as they are lost, and
+    every full_interval frames to pick up targets that entered elsewhere.
+    """
+    def __init__(self, pad, confirm, full_interval):
+        self.pad = pad
+        self.confirm = confirm
+        self.full_interval = full_interval
+        self.rects = ()
+        self.hits = 0
+        self.since_full = 0
+
+    def window(self, frame_shape):
+        """(x, y, w, h) to process, None for the full frame"""
+        rects = self.rects  # Workers update it, read once
+        if self.hits < self.confirm or not rects or self.since_full >= self.full_interval:
+            return None
+        self.since_full += 1
+        return pad_rect(union_rect(rects), self.pad, frame_shape)
+
+    def update(self, rects, window):
+        """Full frame bounding rects found when processing window"""
+        if window is None:
+            self.since_full = 0
+        if rects:
+            self.hits += 1
+            self.rects = tuple(rects)
+        else:
+            self.hits = 0
+            self.rects = ()
@@ -0,0 +1,122 @@
+import cv2
+import numpy as np
+
+from functools import lru_cache
+
+from tracker import yuyv
+
+
+LUT_BITS = 6  # Per channel, 2^18 entry table
+
+
+@lru_cache(maxsize=8)
+def build_lut(conversion, low, high, packed=False):
+    """In/out decision for the centre of every quantised BGR cell, or Y, U, V cell if packed
+
+    Cached, so when a range is tuned every worker's ColorThreshold shares one build. Packed
+    cells are converted to BGR as the camera driver would have, then like any other.
+    """
+    levels = 1 << LUT_BITS
+    centres = (np.arange(levels, dtype=np.uint16) << (8 - LUT_BITS)) + (1 << (7 - LUT_BITS))
+    c0, c1, c2 = np.meshgrid(centres, centres, centres, indexing='ij')
+    if packed:  # A pixel pair per cell, both Y then U and V
+        pairs = np.stack((c0, c1, c0, c2), axis=-1).astype(np.uint8)
+        grid = yuyv.to_bgr(pairs.reshape(levels ** 2, levels * 2, 2))[:, ::2].copy()
+    else:
+        grid = np.stack((c0, c1, c2), axis=-1).astype(np.uint8).reshape(levels ** 2, levels, 3)
+    converted = grid if conversion is None else cv2.cvtColor(grid, conversion)
+    lut = cv2.inRange(converted, low, high).reshape(-1)
+    lut.flags.writeable = False
+    return lut
+
+
+class ColorThreshold(object):
+    """BGR to 0/255 mask by a colour space range, no allocations after the first frame
+
+    'convert' converts into a reused buffer, then inRange writes into a reused mask.
+    'lut' looks each pixel up in a table over quantised BGR, built once from the same
+    conversion, so there is no intermediate colour image. It is rebuilt only when the range
+    changes. Which is faster depends on how well OpenCV vectorises the conversion on the host.
+    A conversion of None thresholds BGR as is.
+    Packed YUYV frames are converted to BGR here instead of by the camera driver, or with
+    'lut' looked up in a table over their own layout, so no conversion is made at all.
+    """
+    def __init__(self, conversion, mode='convert'):
+        if mode not in ('convert', 'lut'):
+            raise ValueError("Unknown threshold mode '{}'".format(mode))
+        self.conversion = conversion
+        self.mode = mode
+        self.low = None
+        self.high = None
+        self.lut = None
+        self.packed_lut = None
+        self._shift = np.array([v >> (8 - LUT_BITS) for v in range(256)], dtype=np.uint8)
+        self._buffers = {}
+
+    def set_range(self, low, high):
+        """Inclusive per channel limits in the converted colour space"""
+        low = tuple(low)
+        high = tuple(high)
+        if low != self.low or high != self.high:
+            self.low = low
+            self.high = high
+            self.lut = None  # Stale, rebuilt on next use
+            self.packed_lut = None
+
+    def apply(self, src):
+        """Mask of src, valid until the next call"""
+        if self.mode == 'lut' and yuyv.is_yuyv(src):
+            return self._apply_packed(src, self._buffer('mask', src.shape[:2], np.uint8))
+        if self.mode == 'lut':
+            return self._apply_lut(src, self._buffer('mask', src.shape[:2], np.uint8))
+        return self.in_range(self.convert(src))
+
+    def convert(self, src):
+        """src in the threshold's colour space, valid until the next call"""
+        if yuyv.is_yuyv(src):
+            src = yuyv.to_bgr(src, self._buffer('bgr', src.shape[:2] + (3,), np.uint8))
+        if self.conversion is None:
+            return src
+        converted = self._buffer('converted', src.shape, np.uint8)
+        return cv2.cvtColor(src, self.conversion, dst=converted)
+
+    def in_range(self, converted):
+        """Mask of an already converted image, valid until the next call"""
+        mask = self._buffer('mask', converted.shape[:2], np.uint8)
+        return cv2.inRange(converted, self.low, self.high, dst=mask)
+
+    def _apply_lut(self, src, mask):
+        if self.lut is None:
+            self.lut = build_lut(self.conversion, self.low, self.high)
+        quantised = self._buffer('quantised', src.shape, np.uint8)
+        index = self._buffer('index', src.shape[:2], np.uint32)
+        scratch = self._buffer('scratch', src.shape[:2], np.uint32)
+        cv2.LUT(src, self._shift, dst=quantised)
+        np.left_shift(quantised[..., 0], 2 * LUT_BITS, out=index, dtype=np.uint32)
+        np.left_shift(quantised[..., 1], LUT_BITS, out=scratch, dtype=np.uint32)
+        np.bitwise_or(index, scratch, out=index)
+        np.bitwise_or(index, quantised[..., 2], out=index)
+        return np.take(self.lut, index, out=mask)
+
+    def _apply_packed(self, src, mask):
+        if self.packed_lut is None:
+            self.packed_lut = build_lut(self.conversion, self.low, self.high, packed=True)
+        height, width = src.shape[:2]
+        quantised = self._buffer('quantised', src.shape, np.uint8)
+        chroma = self._buffer('chroma', (height, width // 2), np.uint32)
+        index = self._buffer('index', (height, width // 2, 2), np.uint32)
+        cv2.LUT(src, self._shift, dst=quantised)
+        pairs = quantised.reshape(height, width // 2, 2, 2)  # Pair, pixel, Y then U or V
+        np.left_shift(pairs[:, :, 0, 1], LUT_BITS, out=chroma, dtype=np.uint32)
+        np.bitwise_or(chroma, pairs[:, :, 1, 1], out=chroma)
+        np.left_shift(pairs[..., 0], 2 * LUT_BITS, out=index, dtype=np.uint32)
+        np.bitwise_or(index, chroma[..., None], out=index)
+        return np.take(self.packed_lut, index.reshape(height, width), out=mask)
+
+    def _buffer(self, name, shape, dtype):
+        """Reused storage, a view of a flat buffer that only ever grows"""
+        size = int(np.prod(shape))
+        flat = self._buffers.get(name)
+        if flat is None or flat.size < size:
+            flat = self._buffers[name] = np.empty(size, dtype=dtype)
+        return flat[:size].reshape(shape)
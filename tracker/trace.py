@@ -0,0 +1,162 @@
+import json
+import threading
+
+from bisect import bisect_left
+from time import time
+
+from tracker.util import bucket_quantile
+
+
+# Upper bounds in seconds, 1-2-5 steps from 50us to 2s, plus +Inf
+BUCKETS = (.00005, .0001, .0002, .0005, .001, .002, .005, .01, .02, .05, .1, .2, .5, 1.0, 2.0)
+
+
+class FrameTrace(object):
+    """Timestamps of one frame on its way from the camera to the RIO"""
+    __slots__ = ('frame_id', 'events', 'steps')
+
+    def __init__(self, frame_id, t_taken, t_published):
+        self.frame_id = frame_id
+        self.events = [('capture', t_taken), ('enqueue', t_published)]
+        self.steps = ()
+
+    def mark(self, event):
+        """Stamp event now"""
+        self.events.append((event, time()))
+
+    def stages(self):
+        """(stage, seconds) for each gap between events, each pipeline step, and the total"""
+        events = self.events
+        for (_, t_before), (event, t_after) in zip(events, events[1:]):
+            yield event, t_after - t_before
+        for step, seconds in self.steps:
+            yield 'step_' + step, seconds
+        yield 'total', events[-1][1] - events[0][1]
+
+
+class Histogram(object):
+    """Fixed bucket latency histogram, only ever written by one thread"""
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def record(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimate, interpolated within the bucket holding the q'th sample"""
+        return bucket_quantile(BUCKETS, self.counts, self.count, q)
+
+
+class Metrics(object):
+    """Per stage latency histograms, served by the video HTTP server
+
+    Every recording thread gets its own set of histograms so the hot path never takes a
+    lock, readers merge the sets. Recording a frame's seven or so stages costs 15 - 20
+    microseconds, about twice that with the processor's recent windows as well.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._sets = []
+        self._lock = threading.Lock()  # Only taken when a thread records for the first time
+        self._counters = {}
+        self._windows = {}
+
+    def _histograms(self):
+        histograms = getattr(self._local, 'histograms', None)
+        if histograms is None:
+            histograms = self._local.histograms = {}
+            with self._lock:
+                self._sets.append(histograms)
+        return histograms
+
+    def observe(self, stage, seconds):
+        """Add one sample for stage"""
+        histograms = self._histograms()
+        histogram = histograms.get(stage)
+        if histogram is None:
+            histogram = histograms[stage] = Histogram()
+        histogram.record(seconds)
+
+    def record(self, trace, prefix=''):
+        """Each gap between a frame's events, each pipeline step, and the end to end total
+
+        prefix tells apart the stages of different cameras.
+        """
+        for stage, seconds in trace.stages():
+            self.observe(prefix + stage, seconds)
+
+    def counter(self, name, read):
+        """Expose a count, read() is called when metrics are requested"""
+        self._counters[name] = read
+
+    def window(self, name, stats):
+        """Expose a WindowedStats of seconds, the recent figures beside the totals"""
+        self._windows[name] = stats
+
+    def recent(self):
+        """Window name to its snapshot"""
+        return {name: stats.snapshot() for name, stats in sorted(self._windows.items())}
+
+    def merged(self):
+        """Stage name to Histogram over all threads"""
+        merged = {}
+        with self._lock:
+            sets = list(self._sets)
+        for histograms in sets:
+            for stage, histogram in list(histograms.items()):
+                merged.setdefault(stage, Histogram()).merge(histogram)
+        return merged
+
+    def to_json(self):
+        stages = {}
+        for stage, histogram in sorted(self.merged().items()):
+            stages[stage] = {
+                'count': histogram.count,
+                'mean_ms': round(1000.0 * histogram.total / max(histogram.count, 1), 3),
+                'p50_ms': round(1000.0 * histogram.quantile(.50), 3),
+                'p95_ms': round(1000.0 * histogram.quantile(.95), 3),
+                'p99_ms': round(1000.0 * histogram.quantile(.99), 3),
+            }
+        counters = {name: read() for name, read in self._counters.items()}
+        recent = {}
+        for name, snapshot in self.recent().items():
+            recent[name] = {'count': snapshot.pop('count')}
+            recent[name].update((stat + '_ms', round(1000.0 * value, 3))
+                                for stat, value in snapshot.items())
+        return json.dumps({'stages': stages, 'counters': counters, 'recent': recent},
+                          indent=4)
+
+    def to_prometheus(self):
+        lines = ['# TYPE tracker_stage_seconds histogram']
+        for stage, histogram in sorted(self.merged().items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('tracker_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                    stage, bound, cumulative))
+            lines.append('tracker_stage_seconds_sum{{stage="{}"}} {}'.format(
+                stage, histogram.total))
+            lines.append('tracker_stage_seconds_count{{stage="{}"}} {}'.format(
+                stage, histogram.count))
+        for name, read in sorted(self._counters.items()):
+            lines.append('# TYPE tracker_{}_total counter'.format(name))
+            lines.append('tracker_{}_total {}'.format(name, read()))
+        lines.append('# TYPE tracker_recent_seconds gauge')
+        for name, snapshot in self.recent().items():
+            del snapshot['count']
+            for stat, value in snapshot.items():
+                lines.append('tracker_recent_seconds{{window="{}",stat="{}"}} {}'.format(
+                    name, stat, value))
+        return '\n'.join(lines) + '\n'
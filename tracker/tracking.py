@@ -0,0 +1,119 @@
+import numpy as np
+
+
+H = np.array([[1., 0., 0., 0.], [0., 1., 0., 0.]])  # Only the centre is measured
+
+
+class TargetTracker(object):
+    """Follows targets from frame to frame, with a stable id and a velocity for each
+
+    Every target is a constant velocity Kalman filter on its centre in pixels, all filtered
+    together as arrays. Detections go to the nearest predicted target within gate pixels,
+    a target not detected is coasted on its velocity for up to coast frames. Reports are
+    projected forward to when the robot will use them, covering the pipeline's latency.
+    """
+    def __init__(self, gate=60.0, coast=2, process_noise=2000.0, measurement_noise=3.0,
+                 initial_speed=500.0):
+        self.gate = gate
+        self.coast = coast
+        self.process_noise = process_noise  # Acceleration, pixels/s^2
+        self.measurement_noise = measurement_noise ** 2
+        self.initial = np.diag([self.measurement_noise] * 2 + [initial_speed ** 2] * 2)
+        self.state = np.zeros((0, 4))  # x, y, vx, vy
+        self.covariance = np.zeros((0, 4, 4))
+        self.sizes = np.zeros((0, 2))
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.misses = np.zeros(0, dtype=np.int64)
+        self.next_id = 0
+        self.t_state = None
+
+    def predict(self, dt):
+        """Move every target dt seconds along its velocity, growing its uncertainty"""
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        q = self.process_noise ** 2
+        Q = q * np.array([[dt ** 4 / 4, 0, dt ** 3 / 2, 0],
+                          [0, dt ** 4 / 4, 0, dt ** 3 / 2],
+                          [dt ** 3 / 2, 0, dt ** 2, 0],
+                          [0, dt ** 3 / 2, 0, dt ** 2]])
+        self.state = self.state @ F.T
+        self.covariance = F @ self.covariance @ F.T + Q
+
+    def associate(self, centres):
+        """(target index, detection index) pairs, nearest first, each used at most once"""
+        if not len(self.state) or not len(centres):
+            return []
+        offsets = self.state[:, None, :2] - centres[None, :, :]
+        distances = np.hypot(offsets[..., 0], offsets[..., 1])
+        pairs = []
+        used_targets, used_detections = set(), set()
+        for flat in np.argsort(distances, axis=None):
+            target, detection = divmod(int(flat), len(centres))
+            if distances[target, detection] > self.gate:
+                break
+            if target in used_targets or detection in used_detections:
+                continue
+            pairs.append((target, detection))
+            used_targets.add(target)
+            used_detections.add(detection)
+        return pairs
+
+    def correct(self, targets, centres):
+        """Kalman update of targets with their measured centres"""
+        P = self.covariance[targets]
+        S = P[:, :2, :2] + self.measurement_noise * np.eye(2)
+        a, b, c, d = S[:, 0, 0], S[:, 0, 1], S[:, 1, 0], S[:, 1, 1]  # Closed form 2x2 inverse
+        S_inv = np.stack((d, -b, -c, a), axis=1).reshape(-1, 2, 2)
+        S_inv /= (a * d - b * c)[:, None, None]
+        K = P[:, :, :2] @ S_inv
+        innovation = centres - self.state[targets, :2]
+        self.state[targets] += np.einsum('nij,nj->ni', K, innovation)
+        self.covariance[targets] = P - K @ (H @ P)
+
+    def update(self, rects, t_taken):
+        """Fold in one frame's (x, y, w, h) detections, taken at t_taken"""
+        if self.t_state is not None and len(self.state):
+            self.predict(max(t_taken - self.t_state, 0.0))
+        self.t_state = t_taken
+        rects = np.array(rects, dtype=float).reshape(-1, 4)
+        centres = rects[:, :2] + rects[:, 2:] / 2
+
+        pairs = self.associate(centres)
+        matched = np.array([t for t, _ in pairs], dtype=np.int64)
+        detected = np.array([d for _, d in pairs], dtype=np.int64)
+        if len(pairs):
+            self.correct(matched, centres[detected])
+            self.sizes[matched] = rects[detected, 2:]
+        self.misses += 1
+        self.misses[matched] = 0
+
+        keep = self.misses <= self.coast
+        new = np.ones(len(rects), dtype=bool)
+        new[detected] = False
+        if keep.all() and not new.any():
+            return
+        new = np.flatnonzero(new)
+        self.state = np.concatenate((self.state[keep],
+                                     np.hstack((centres[new], np.zeros((len(new), 2))))))
+        self.covariance = np.concatenate((self.covariance[keep],
+                                          np.repeat(self.initial[None], len(new), axis=0)))
+        self.sizes = np.concatenate((self.sizes[keep], rects[new, 2:]))
+        self.ids = np.concatenate((self.ids[keep],
+                                   np.arange(self.next_id, self.next_id + len(new))))
+        self.misses = np.concatenate((self.misses[keep], np.zeros(len(new), dtype=np.int64)))
+        self.next_id += len(new)
+
+    def targets(self, t_target, frame_w, frame_h):
+        """(x, y, w, h, vx, vy, id) of every target projected to t_target, oldest id first
+
+        Positions are the top left corner from -1 to 1 about the image centre and velocities
+        are in the same units per second, as for untracked targets.
+        """
+        dt = t_target - self.t_state if self.t_state is not None else 0.0
+        centre = np.array((frame_w / 2.0, frame_h / 2.0))
+        corners = self.state[:, :2] + self.state[:, 2:] * dt - self.sizes / 2
+        positions = (corners - centre) / centre
+        velocities = self.state[:, 2:] / centre
+        return [(x, y, int(w), int(h), vx, vy, int(i)) for (x, y), (w, h), (vx, vy), i in
+                zip(positions.tolist(), self.sizes.tolist(), velocities.tolist(),
+                    self.ids.tolist())]
@@ -1,60 +1,97 @@
-import numpy as np
+import threading
 
+from bisect import bisect_left
 
-class CircularBuffer(object):
-    def __init__(self, size_max, default_value=0.0, dtype=float):
-        self.size_max = size_max
 
-        self._data = np.empty(size_max, dtype=dtype)
-        self._data.fill(default_value)
+def bucket_quantile(bounds, counts, count, q):
+    """Estimate from bucket counts, interpolated within the bucket holding the q'th sample
 
-        self.size = 0
+    counts has one more entry than bounds, for samples above the last bound.
+    """
+    if count == 0:
+        return 0.0
+    rank = q * count
+    seen = 0
+    for i, bucket_count in enumerate(counts):
+        if bucket_count and seen + bucket_count >= rank:
+            low = bounds[i - 1] if i > 0 else 0.0
+            high = bounds[i] if i < len(bounds) else bounds[-1] * 2
+            return low + (high - low) * (rank - seen) / bucket_count
+        seen += bucket_count
+    return bounds[-1]
 
-    def append(self, value):
-        self._data = np.roll(self._data, 1)
-        self._data[0] = value
 
-        self.size += 1
+class WindowedStats(object):
+    """Statistics over the last size samples, constant time to add one
 
-        if self.size == self.size_max:
-            self.__class__ = CircularBufferFull
+    Keeps running sums and per bucket counts that the evicted sample is taken back out of,
+    percentiles come from the buckets. Safe to snapshot from another thread.
+    """
+    def __init__(self, size, bounds):
+        self.size = size
+        self.bounds = bounds
+        self._values = [0.0] * size
+        self._buckets = [0] * size
+        self._counts = [0] * (len(bounds) + 1)
+        self._head = 0
+        self._count = 0
+        self._sum = 0.0
+        self._sum_squares = 0.0
+        self._lock = threading.Lock()
 
-    def get_last(self):
-        return self._data[0]
-
-    def get_all(self):
-        """Return a list of elements from the oldest to the newest"""
-        return self._data
-
-    def get_partial(self):
-        return self.get_all()[0:self.size]
-
-    def get_average(self, ndigits=-1):
-        if self.size == 0:
-            return 0
-        else:
-            ret = np.cumsum(self.get_all(), dtype=float)
-            ret[self.size:] = ret[self.size:] - ret[:-self.size]
-            ret = (ret[self.size - 1:] / self.size)[0]
-            if ndigits < 0:
-                return ret
+    def add(self, value):
+        bucket = bisect_left(self.bounds, value)
+        with self._lock:
+            head = self._head
+            if self._count == self.size:
+                old = self._values[head]
+                self._sum -= old
+                self._sum_squares -= old * old
+                self._counts[self._buckets[head]] -= 1
+            else:
+                self._count += 1
+            self._values[head] = value
+            self._buckets[head] = bucket
+            self._counts[bucket] += 1
+            self._head = head = (head + 1) % self.size
+            if head == 0:  # Once a window, so rounding in the running sums never builds up
+                self._sum = sum(self._values)
+                self._sum_squares = sum(v * v for v in self._values)
             else:
-                return round(ret, ndigits)
+                self._sum += value
+                self._sum_squares += value * value
 
-    def __getitem__(self, key):
-        return self._data[key]
+    @property
+    def count(self):
+        return self._count
 
-    def __repr__(self):
-        """Return string representation"""
-        s = self._data.__repr__()
-        s = s + '\t' + str(self.size)
-        s = s + '\t' + self.get_all()[::-1].__repr__()
-        s = s + '\t' + self.get_partial()[::-1].__repr__()
-        return s
+    @property
+    def mean(self):
+        count = self._count
+        return self._sum / count if count else 0.0
 
+    def snapshot(self):
+        """count, mean, min, max, stddev, p50, p95 and p99 of the window"""
+        with self._lock:
+            count = self._count
+            values = self._values[:count]
+            total, squares = self._sum, self._sum_squares
+            counts = list(self._counts)
+        if count == 0:
+            return dict(count=0, mean=0.0, min=0.0, max=0.0, stddev=0.0,
+                        p50=0.0, p95=0.0, p99=0.0)
+        mean = total / count
+        low, high = min(values), max(values)
 
-class CircularBufferFull(CircularBuffer):
-    def append(self, value):
-        """Append an element when buffer is full"""
-        self._data = np.roll(self._data, 1)
-        self._data[0] = value
+        def quantile(q):
+            return min(max(bucket_quantile(self.bounds, counts, count, q), low), high)
+        return dict(
+            count=count,
+            mean=mean,
+            min=low,
+            max=high,
+            stddev=max(squares / count - mean * mean, 0.0) ** 0.5,
+            p50=quantile(.50),
+            p95=quantile(.95),
+            p99=quantile(.99),
+        )
@@ -1,4 +1,4 @@
-#!python3.6
+#!python3.8
 
 import argparse
 import json
@@ -6,60 +6,143 @@ import logging
 import os
 
 from multiprocessing import Queue, Process
+from multiprocessing.connection import wait
 from threading import Thread
-from time import sleep
+from time import time
 
-from tracker.camera import camera_process
+from tracker.camera import camera_configs, camera_process
+from tracker.frame_ring import FrameRing
 from tracker.processor import processing_process
 
 
+ROBOT_CONFIG = os.path.join('config', 'robot.json')
+LOCAL_CONFIG = os.path.join('config', 'test_local.json')
+
+
 def load_config(path_rel, grip, show_local):
     """Read JSON, update with arparse args, return dict"""
     if path_rel is None:
-        path_rel = 'config\\robot.json'
+        path_rel = ROBOT_CONFIG
     pwd = os.path.dirname(__file__)
     path_abs = os.path.join(pwd, path_rel)
     with open(path_abs, 'r') as f:
         s = f.read()
         config = json.loads(s)
-        config.update({'grip': grip, 'show': show_local})
+        config.update({'grip': grip, 'show': show_local, 'config_path': path_abs})
         for key, val in config.items():
             print(key, val)
     return config
 
 
 def start_target_tracker(config):
-    """STEM Alliance of Fargo Moorhead Vision Coprocessor Application"""
-    queue = Queue(1)  # Camera to Processor frames, size of 1: Camera blocked until pop
-    args = (config, queue)
-    camera = Process(target=camera_process, args=args, name='Camera', daemon=True)
-    processor = Thread(target=processing_process, args=args, name='Processing', daemon=True)
-
+    """STEM Alliance of Fargo Moorhead Vision Coprocessor Application
+
+    Cameras start first, opening one is the slowest part of startup, and the processing
+    warms up its pipelines meanwhile. Returns the Supervisor watching the cameras.
+    """
+    cameras = []
+    for camera_config in camera_configs(config):
+        queue = Queue(1)  # Camera to Processor slot indices, size of 1: Camera blocked until pop
+        control = Queue(4)  # Processor to Camera, settings sent by the RIO
+        ring = make_ring(camera_config, queue_size=1)
+        cameras.append((camera_config, ring, queue, control))
+    supervisor = Supervisor(cameras)
+    supervisor.start()
+    processor = Thread(target=processing_process, args=(config, cameras), name='Processing',
+                       daemon=True)
     processor.start()
-    camera.start()
+    return supervisor
+
+
+class Supervisor(object):
+    """Runs a process per camera, restarting any that dies on the same ring and queues
+
+    The processor keeps running through a restart, it just sees no frames for a moment. A
+    camera that dies within holdoff seconds of starting waits that long, so a crash on
+    startup doesn't spin.
+    """
+    def __init__(self, cameras, holdoff=1.0):
+        self.log = logging.getLogger('Supervisor')
+        self.log.setLevel(logging.INFO)
+        self.cameras = cameras
+        self.holdoff = holdoff
+        self.processes = {}  # Process sentinel to (process, camera, start time)
+        self.pending = []  # (restart time, camera) held off
+        self.restarts = 0
+
+    def start(self):
+        for camera in self.cameras:
+            self.spawn(camera)
+
+    def spawn(self, camera):
+        camera_config, ring, queue, control = camera
+        process = Process(target=camera_process, args=(camera_config, ring, queue, control),
+                          name='Camera{}'.format(camera_config['id']), daemon=True)
+        process.start()
+        self.processes[process.sentinel] = (process, camera, time())
+
+    def watch(self, timeout):
+        """Restart camera processes that exit within timeout seconds"""
+        now = time()
+        for due, camera in [entry for entry in self.pending if entry[0] <= now]:
+            self.pending.remove((due, camera))
+            self.spawn(camera)
+        for sentinel in wait(list(self.processes), timeout):  # Block: Until a camera exits
+            process, camera, t_started = self.processes.pop(sentinel)
+            t_exit = time()
+            process.join()
+            reclaimed = camera[1].reclaim(camera[2])
+            self.restarts += 1
+            if t_exit - t_started < self.holdoff:
+                self.pending.append((t_exit + self.holdoff, camera))
+                self.log.warning("{} exited with code {} on startup, restarting in {:.0f}s"
+                                 .format(process.name, process.exitcode, self.holdoff))
+                continue
+            self.spawn(camera)
+            self.log.warning("{} exited with code {}, restarted in {:.1f}ms, {} slot(s) "
+                             "reclaimed".format(process.name, process.exitcode,
+                                                1000.0 * (time() - t_exit), reclaimed))
+
+    def rings(self):
+        return [ring for _, ring, _, _ in self.cameras]
+
+
+def make_ring(config, queue_size):
+    """Shared memory frames: one per queue entry and one per worker
+
+    In queue mode that is all, so the camera only gets a slot to capture into once a worker
+    has finished a frame and the queue has room: it never holds a frame waiting to put it.
+    Latest mode has one more, being captured while the queue is full, to replace the frame
+    waiting there.
+    """
+    slots = queue_size + config.get('workers', 1)
+    if config.get('capture', 'queue') == 'latest':
+        slots += 1
+    return FrameRing.create(slots, config['height'], config['width'])
 
 
 # Entry Point
-def main(path='config\\robot.json', grip=True, show_local=False):
+def main(path=ROBOT_CONFIG, grip=True, show_local=False):
     """Team 4818 WFRobotics Vision Coprocessor"""
     logging.basicConfig()
 
-    config = load_config(path, grip, show_local) 
-    start_target_tracker(config)
+    config = load_config(path, grip, show_local)
+    supervisor = start_target_tracker(config)
     print('\n--- Press Ctrl + C to exit ---\n')
 
     while True:
         try:
-            sleep(0.1)  # Yield: Periodically wake so Ctrl + C can kill app
+            supervisor.watch(0.1)  # Yield: Periodically wake so Ctrl + C can kill app
         except KeyboardInterrupt:
             break  # Exit app
+    for ring in supervisor.rings():
+        ring.close()
 
 
 # Entry Point
 def main_local():
     """Test with sockets on this computer"""
-    path = 'config\\test_local.json'
-    main(path, grip=True, show_local=False) 
+    main(LOCAL_CONFIG, grip=True, show_local=False)
 
 
 if __name__ == '__main__':
@@ -79,9 +162,6 @@ if __name__ == '__main__':
                            action='store_true')
     args = arg_parse.parse_args()
 
-    if args.local:
-        path = 'config\\test_local.json'
-    else:
-        path = 'config\\robot.json'
+    path = LOCAL_CONFIG if args.local else ROBOT_CONFIG
 
     main(path, grip=not args.no_grip, show_local=args.show_local)
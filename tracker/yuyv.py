@@ -0,0 +1,33 @@
+"""Packed YUYV 4:2:2 frames, as cameras deliver them with CAP_PROP_CONVERT_RGB off
+
+A frame is height x width x 2: channel 0 is every pixel's Y, channel 1 alternates U on even
+and V on odd columns, each pair of pixels sharing one U and V. Crops and resizes keep those
+pairs together, so columns are kept to even numbers.
+"""
+import cv2
+
+
+def is_yuyv(frame):
+    return frame.ndim == 3 and frame.shape[2] == 2
+
+
+def to_bgr(frame, dst=None):
+    return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_YUYV, dst=dst)
+
+
+def align(rect, frame_shape):
+    """rect widened to start and end on a pixel pair"""
+    x, y, w, h = rect
+    x0 = x & ~1
+    x1 = min((x + w + 1) & ~1, frame_shape[1] & ~1)
+    return x0, y, x1 - x0, h
+
+
+def resize(frame, size, dst=None, interpolation=cv2.INTER_AREA):
+    """frame resized to (width, height), width rounded down to even, averaging whole pairs"""
+    width, height = max(size[0] & ~1, 2), size[1]
+    pairs = frame.reshape(frame.shape[0], frame.shape[1] // 2, 4)  # Y0 U Y1 V
+    small = cv2.resize(pairs, (width // 2, height),
+                       dst=None if dst is None else dst.reshape(height, width // 2, 4),
+                       interpolation=interpolation)
+    return small.reshape(height, width, 2)